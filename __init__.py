@@ -3,16 +3,36 @@
 from trytond.pool import Pool
 from . import invoice
 from . import party
+from . import product
 
 
 def register():
     Pool.register(
         party.Party,
         party.PartyAccount,
+        party.InvoiceDiscountBracket,
+        party.InvoiceDiscountPeriod,
+        party.ImportInvoiceDiscountStart,
+        party.ImportInvoiceDiscountDone,
         invoice.Configuration,
+        invoice.ConfigurationDiscountProduct,
+        invoice.ConfigurationDiscountGlobalExcludedCategory,
         invoice.Invoice,
         invoice.InvoiceLine,
+        invoice.Cron,
+        product.Template,
+        product.Product,
+        product.Category,
+        product.CategoryAccount,
+        invoice.PostQueueDone,
+        invoice.DiscountGlobalAnalysis,
+        invoice.DiscountGlobalAnalysisContext,
+        invoice.DiscountGlobalLog,
         module='account_invoice_discount_global', type_='model')
+    Pool.register(
+        invoice.PostQueue,
+        party.ImportInvoiceDiscount,
+        module='account_invoice_discount_global', type_='wizard')
     Pool.register(
         invoice.Purchase,
         depends=['purchase'],
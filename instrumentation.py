@@ -0,0 +1,174 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Opt-in instrumentation of the global discount computation
+
+It is enabled with:
+
+    [account_invoice_discount_global]
+    instrumentation = True
+
+Each instrumented call is logged at INFO level on this module logger and
+accumulated in a per-process structure returned by get_stats. The SQL
+statements are counted by wrapping the execute method of the cursors of the
+database backends only while an instrumented call is running, so the
+logging level of the backends is not changed.
+"""
+import importlib
+import logging
+import threading
+import time
+from functools import wraps
+
+from trytond import config
+
+logger = logging.getLogger(__name__)
+
+_BACKEND_CURSORS = [
+    ('trytond.backend.postgresql.database', 'LoggingCursor'),
+    ('trytond.backend.sqlite.database', 'SQLiteCursor'),
+    ]
+_COUNTERS = ['calls', 'invoices', 'lines', 'queries']
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_stats = {}
+_caches = {}
+_cursors = {}
+_running = 0
+
+
+def _count_queries(execute):
+    "Wrap the execute method of a cursor to count the queries"
+    @wraps(execute)
+    def wrapper(self, *args, **kwargs):
+        for frame in getattr(_local, 'frames', ()):
+            frame['queries'] += 1
+        return execute(self, *args, **kwargs)
+    return wrapper
+
+
+def _start():
+    "Wrap the cursors when the first instrumented call of the process starts"
+    global _running
+    with _lock:
+        _running += 1
+        if _running > 1:
+            return
+        for module_name, name in _BACKEND_CURSORS:
+            try:
+                module = importlib.import_module(module_name)
+            except ImportError:
+                continue
+            Cursor = getattr(module, name)
+            _cursors[Cursor] = Cursor.__dict__.get('execute')
+            Cursor.execute = _count_queries(Cursor.execute)
+
+
+def _stop():
+    "Restore the cursors when the last instrumented call of the process ends"
+    global _running
+    with _lock:
+        _running -= 1
+        if _running:
+            return
+        for Cursor, execute in _cursors.items():
+            if execute is None:
+                del Cursor.execute
+            else:
+                Cursor.execute = execute
+        _cursors.clear()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_stats():
+    "Return a copy of the counters accumulated by the process"
+    with _lock:
+        stats = {name: dict(values) for name, values in _stats.items()}
+        caches = {}
+        for name, (hits, misses) in _caches.items():
+            total = hits + misses
+            caches[name] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / total if total else None,
+                }
+    return {'calls': stats, 'caches': caches}
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
+        _caches.clear()
+
+
+def instrumented(name):
+    "Decorate func to measure its calls when the instrumentation is enabled"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            frames = _local.__dict__.setdefault('frames', [])
+            frame = dict.fromkeys(_COUNTERS, 0)
+            frames.append(frame)
+            _start()
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                _stop()
+                frames.pop()
+                frame['calls'] = 1
+                with _lock:
+                    values = _stats.setdefault(
+                        name, dict.fromkeys(_COUNTERS + ['elapsed'], 0))
+                    for key, value in frame.items():
+                        values[key] += value
+                    values['elapsed'] += elapsed
+                logger.info(
+                    "%s: %.6fs, %s invoices, %s lines, %s queries",
+                    name, elapsed, frame['invoices'], frame['lines'],
+                    frame['queries'])
+        return wrapper
+    return decorator
+
+
+def add(key, value):
+    "Add value to the counter key of the innermost instrumented call"
+    if _enabled:
+        frames = getattr(_local, 'frames', None)
+        if frames:
+            frames[-1][key] += value
+
+
+def cache(name, hit):
+    "Record a hit or a miss of the cache name"
+    if _enabled:
+        with _lock:
+            hits, misses = _caches.get(name, (0, 0))
+            if hit:
+                hits += 1
+            else:
+                misses += 1
+            _caches[name] = (hits, misses)
+
+
+if config.getboolean(
+        'account_invoice_discount_global', 'instrumentation', default=False):
+    enable()
@@ -1,19 +1,251 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from decimal import Decimal
-from trytond.model import ModelView, Workflow, fields
+from collections import defaultdict
+from decimal import ROUND_HALF_EVEN, Decimal
+from itertools import chain
+from sql import Cast, Column, Literal, Null
+from sql.aggregate import Count, Max, Min, Sum
+from sql.functions import CurrentTimestamp
+from sql.operators import Equal
+from trytond import backend, config
+from trytond.cache import Cache, freeze
+from trytond.model import (
+    Exclude, Index, ModelSQL, ModelView, Workflow, fields)
+from trytond.model.exceptions import AccessButtonError, AccessError
+from trytond.modules.account.exceptions import FiscalYearNotFoundError
+from trytond.modules.company.model import CompanyValueMixin
+from trytond.modules.currency.fields import Monetary
 from trytond.pool import PoolMeta, Pool
-from trytond.pyson import Eval
+from trytond.pyson import Eval, If
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.tools import grouped_slice, reduce_ids, sqlite_apply_types
+from trytond.rpc import RPC
+from trytond.transaction import Transaction, without_check_access
+from trytond.wizard import Button, StateTransition, StateView, Wizard
 from trytond.modules.product import price_digits, round_price
 
-__all__ = ['Configuration', 'Invoice', 'InvoiceLine', 'Sale', 'Purchase']
+from . import instrumentation
+from .instrumentation import instrumented
+
+NO_BRACKETS = ((), ())
+
+__all__ = ['Configuration', 'ConfigurationDiscountProduct',
+    'ConfigurationDiscountGlobalExcludedCategory', 'Invoice',
+    'InvoiceLine', 'Cron', 'PostQueue', 'PostQueueDone',
+    'DiscountGlobalAnalysis', 'DiscountGlobalAnalysisContext',
+    'DiscountGlobalLog', 'Sale', 'Purchase']
 
 
 class Configuration(metaclass=PoolMeta):
     __name__ = 'account.configuration'
-    discount_product = fields.Many2One('product.product', 'Discount Product')
+    discount_product = fields.MultiValue(fields.Many2One(
+            'product.product', 'Discount Product',
+            context={
+                'company': Eval('context', {}).get('company', -1),
+                }))
+    discount_global_update = fields.MultiValue(fields.Boolean(
+            "Update Global Discount Line",
+            help="Keep the global discount line when the invoice goes back "
+            "to draft and update its amount when it is validated again."))
+    discount_global_per_tax = fields.MultiValue(fields.Boolean(
+            "Distribute Global Discount per Tax",
+            help="Create one global discount line per group of taxes of the "
+            "invoice lines in proportion to their untaxed amount."))
+    post_queue_size = fields.Integer("Post Queue Chunk Size",
+        domain=['OR',
+            ('post_queue_size', '=', None),
+            ('post_queue_size', '>', 0),
+            ],
+        help="The number of invoices processed by each task when posting "
+        "or updating in the background.\n"
+        "Leave empty to use the batch size of the queue.")
+    discount_global_excluded_categories = fields.Many2Many(
+        'account.configuration.discount_global.excluded_category',
+        'configuration', 'category',
+        "Categories Excluded from Global Discount",
+        help="The lines of the products of these categories and their "
+        "children are not part of the global discount base.")
+    _discount_product_cache = Cache(
+        __name__ + '.discount_product_values', context=False)
+    _discount_global_excluded_cache = Cache(
+        __name__ + '.discount_global_excluded_products', context=False)
+    _discount_product_ids_cache = Cache(
+        __name__ + '.discount_product_ids', context=False)
+
+    @classmethod
+    def multivalue_model(cls, field):
+        pool = Pool()
+        if field in {'discount_product', 'discount_global_update',
+                'discount_global_per_tax'}:
+            return pool.get('account.configuration.discount_product')
+        return super(Configuration, cls).multivalue_model(field)
+
+    @classmethod
+    def get_discount_product_values(cls, company, invoice_type):
+        """
+        Return a dictionary with the discount product of the company and the
+        account, unit and description of its global discount lines for the
+        invoice type. The dictionary is empty if there is no product.
+        """
+        transaction = Transaction()
+        key = (company.id, invoice_type, transaction.language)
+        values = cls._discount_product_cache.get(key)
+        instrumentation.cache('discount_product', values is not None)
+        if values is not None:
+            return values
+
+        values = {}
+        with transaction.set_context(company=company.id):
+            config = cls(1)
+            product = config.get_multivalue(
+                'discount_product', company=company.id)
+            if product:
+                values = cls._get_discount_product_values(
+                    product, invoice_type)
+        cls._discount_product_cache.set(key, values)
+        return values
+
+    @classmethod
+    def get_discount_product_ids(cls):
+        """
+        Return a dictionary with the ids of the discount products of all the
+        companies, of their templates and of their account categories with
+        the parents from which they may inherit the accounts per model name
+
+        The records are searched once and cached.
+        """
+        pool = Pool()
+        ConfigDiscountProduct = pool.get(
+            'account.configuration.discount_product')
+
+        ids = cls._discount_product_ids_cache.get('ids')
+        instrumentation.cache('discount_product_ids', ids is not None)
+        if ids is None:
+            ids = {
+                'product.product': set(),
+                'product.template': set(),
+                'product.category': set(),
+                }
+            for config in ConfigDiscountProduct.search([
+                        ('discount_product', '!=', None),
+                        ]):
+                product = config.discount_product
+                ids['product.product'].add(product.id)
+                ids['product.template'].add(product.template.id)
+                category = product.template.account_category
+                while (category
+                        and category.id not in ids['product.category']):
+                    ids['product.category'].add(category.id)
+                    category = category.parent
+            ids = {k: sorted(v) for k, v in ids.items()}
+            cls._discount_product_ids_cache.set('ids', ids)
+        return {k: frozenset(v) for k, v in ids.items()}
+
+    @classmethod
+    def get_discount_global_excluded_products(cls):
+        """
+        Return the set of the ids of the products whose lines are excluded
+        from the global discount base
+
+        The excluded categories are expanded to their children and the
+        products are searched once and cached.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        product_ids = cls._discount_global_excluded_cache.get('products')
+        instrumentation.cache(
+            'discount_global_excluded', product_ids is not None)
+        if product_ids is not None:
+            return frozenset(product_ids)
+
+        config = cls(1)
+        category_ids = [
+            c.id for c in config.discount_global_excluded_categories]
+        product_ids = []
+        if category_ids:
+            with Transaction().set_context(active_test=False):
+                product_ids = [p.id for p in Product.search([
+                            ('template.categories_all', 'child_of',
+                                category_ids, 'parent'),
+                            ], order=[])]
+        cls._discount_global_excluded_cache.set(
+            'products', sorted(product_ids))
+        return frozenset(product_ids)
+
+    @classmethod
+    def _get_discount_product_values(cls, product, invoice_type):
+        "Return the values of the global discount lines of the product"
+        if invoice_type == 'in':
+            account = product.account_expense_used
+        else:
+            account = product.account_revenue_used
+        return {
+            'product': product.id,
+            'account': account.id,
+            'unit': product.default_uom.id,
+            'description': product.rec_name,
+            }
+
+
+class ConfigurationDiscountProduct(ModelSQL, CompanyValueMixin):
+    "Account Configuration Discount Product"
+    __name__ = 'account.configuration.discount_product'
+    discount_product = fields.Many2One('product.product', 'Discount Product',
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    discount_global_update = fields.Boolean("Update Global Discount Line")
+    discount_global_per_tax = fields.Boolean(
+        "Distribute Global Discount per Tax")
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        cursor = Transaction().connection.cursor()
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        super(ConfigurationDiscountProduct, cls).__register__(module_name)
+
+        # Migration from 7.8: discount product per company
+        config_h = Config.__table_handler__(module_name)
+        if not exist and config_h.column_exist('discount_product'):
+            table = cls.__table__()
+            config = Config.__table__()
+            cursor.execute(*table.insert(
+                    [table.discount_product],
+                    config.select(config.discount_product,
+                        where=config.discount_product != Null)))
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        super(ConfigurationDiscountProduct, cls).on_modification(
+            mode, records, field_names=field_names)
+        Config._discount_product_cache.clear()
+        Config._discount_product_ids_cache.clear()
+
+
+class ConfigurationDiscountGlobalExcludedCategory(ModelSQL):
+    "Account Configuration Global Discount Excluded Category"
+    __name__ = 'account.configuration.discount_global.excluded_category'
+    configuration = fields.Many2One(
+        'account.configuration', "Configuration", required=True,
+        ondelete='CASCADE')
+    category = fields.Many2One(
+        'product.category', "Category", required=True, ondelete='CASCADE')
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        super(ConfigurationDiscountGlobalExcludedCategory, cls
+            ).on_modification(mode, records, field_names=field_names)
+        Config._discount_global_excluded_cache.clear()
 
 
 class Invoice(metaclass=PoolMeta):
@@ -22,108 +254,1052 @@ class Invoice(metaclass=PoolMeta):
         digits=price_digits, states={
             'readonly': Eval('state') != 'draft',
             })
+    discount_global_computed = fields.Boolean(
+        "Global Discount Computed", readonly=True,
+        help="The global discount lines were copied from the credited "
+        "invoice and are not computed again until the lines change.")
+    discount_global_amount = Monetary(
+        "Global Discount", digits='currency', currency='currency',
+        readonly=True,
+        help="The amount deducted by the global discount lines.")
+
+    @classmethod
+    def __setup__(cls):
+        super(Invoice, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.discount_global_amount, Index.Range())),
+                Index(t, (t.company, Index.Equality()),
+                    where=t.state.in_(['posted', 'paid'])
+                    & (t.discount_global_amount != Literal(0))),
+                })
+        cls._check_modify_exclude.add('discount_global_amount')
+        cls.__rpc__.update({
+                'post_queue': RPC(readonly=False, instantiate=0),
+                'simulate_discount_global': RPC(instantiate=0),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        ConfigDiscountProduct = pool.get(
+            'account.configuration.discount_product')
+        Currency = pool.get('currency.currency')
+        Line = pool.get('account.invoice.line')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table_handler__(module_name)
+        sql_table = cls.__table__()
+        config = ConfigDiscountProduct.__table__()
+        currency = Currency.__table__()
+        line = Line.__table__()
+
+        created_discount_global_amount = not table.column_exist(
+            'discount_global_amount')
+
+        super(Invoice, cls).__register__(module_name)
+
+        # Migration from 7.8: store the global discount amount
+        if created_discount_global_amount:
+            if Line.__table_handler__(module_name).column_exist(
+                    'discount_global'):
+                where = line.discount_global == Literal(True)
+            else:
+                where = line.product.in_(config.select(
+                        config.discount_product,
+                        where=config.discount_product != Null))
+            query = line.join(sql_table,
+                condition=line.invoice == sql_table.id
+                ).join(currency, condition=sql_table.currency == currency.id
+                ).select(
+                    sql_table.id, line.quantity,
+                    line.unit_price.as_('unit_price'),
+                    currency.rounding.as_('rounding'),
+                    where=(line.type == 'line') & where)
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, [None, None, 'NUMERIC', 'NUMERIC'])
+            cursor.execute(*query)
+            amounts = defaultdict(Decimal)
+            for invoice_id, quantity, unit_price, rounding in cursor:
+                amounts[invoice_id] -= Currency._round(
+                    Decimal(str(quantity or 0)) * (unit_price or Decimal(0)),
+                    rounding, ROUND_HALF_EVEN)
+            invoice_ids = defaultdict(list)
+            for invoice_id, amount in amounts.items():
+                invoice_ids[amount].append(invoice_id)
+            for amount, ids in invoice_ids.items():
+                for sub_ids in grouped_slice(ids):
+                    cursor.execute(*sql_table.update(
+                            [sql_table.discount_global_amount], [amount],
+                            where=reduce_ids(sql_table.id, sub_ids)))
 
     @staticmethod
     def default_invoice_discount():
         return Decimal(0)
 
-    @fields.depends('party', 'type')
+    @staticmethod
+    def default_discount_global_computed():
+        return False
+
+    @staticmethod
+    def default_discount_global_amount():
+        return Decimal(0)
+
+    @fields.depends('party', 'type', 'company', 'invoice_date')
     def on_change_with_invoice_discount(self):
-        if self.party:
+        if self.party and self.party.id is not None and self.party.id >= 0:
+            # the discounts of the parties are cached
+            key = (self.party.id,
+                self.company.id if self.company else None,
+                'in' if self.type == 'in' else 'out',
+                self.invoice_date)
+            return self.get_party_invoice_discounts({key})[key]
+        elif self.party:
             if self.type == 'in':
                 return self.party.supplier_invoice_discount
             else:
                 return self.party.customer_invoice_discount
 
+    @classmethod
+    def get_party_invoice_discounts(cls, keys):
+        """
+        Return a dictionary with the invoice discount of the party for each
+        (party, company, type, date) key
+
+        The discount of the period of the party containing the date, or today
+        if the date is empty, replaces the discount of the party. The
+        discounts and the periods of all the parties of a company are read at
+        once.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Party = pool.get('party.party')
+        Period = pool.get('party.invoice_discount.period')
+
+        parties = defaultdict(set)
+        for party, company, type_, date in keys:
+            parties[company].add(party)
+        company_discounts = {}
+        company_periods = {}
+        for company, party_ids in parties.items():
+            company_discounts[company] = Party.get_invoice_discounts(
+                party_ids, company=company)
+            if company is not None:
+                for type_ in ['out', 'in']:
+                    company_periods[company, type_] = Period.get_periods(
+                        company, type_, party_ids)
+
+        today = Date.today()
+        discounts = {}
+        for party, company, type_, date in keys:
+            key = (party, company, type_, date)
+            if (company, type_) in company_periods:
+                discount = Period.get_period_discount(
+                    company_periods[company, type_][party], date or today)
+                if discount is not None:
+                    discounts[key] = discount
+                    continue
+            values = company_discounts[company][party]
+            if type_ == 'in':
+                discounts[key] = values['supplier_invoice_discount']
+            else:
+                discounts[key] = values['customer_invoice_discount']
+        return discounts
+
+    @classmethod
+    def create(cls, vlist):
+        context = Transaction().context
+        if context.get('_invoice_discount_batch'):
+            # Set the party invoice discount of the invoices created in batch
+            # by sales and purchases
+            vlist = [v.copy() for v in vlist]
+            to_set = [v for v in vlist
+                if 'invoice_discount' not in v and v.get('party')]
+            keys = {}
+            for values in to_set:
+                keys[id(values)] = (values['party'],
+                    values.get('company', context.get('company')),
+                    values.get('type', cls.default_type()),
+                    values.get('invoice_date'))
+            discounts = cls.get_party_invoice_discounts(set(keys.values()))
+            for values in to_set:
+                values['invoice_discount'] = discounts[keys[id(values)]]
+        return super(Invoice, cls).create(vlist)
+
+    @classmethod
+    def on_modification(cls, mode, invoices, field_names=None):
+        super(Invoice, cls).on_modification(
+            mode, invoices, field_names=field_names)
+        # the global discount must be computed again when the discount of a
+        # draft credit note changes
+        if mode == 'write' and 'invoice_discount' in (field_names or set()):
+            to_reset = [i for i in invoices
+                if i.state == 'draft' and i.discount_global_computed]
+            if to_reset:
+                cls.write(to_reset, {
+                        'discount_global_computed': False,
+                        })
+
     @classmethod
     @ModelView.button
+    @instrumented('compute_discount_global')
     def compute_discount_global(cls, invoices):
-        Line = Pool().get('account.invoice.line')
+        pool = Pool()
+        Line = pool.get('account.invoice.line')
+        Log = pool.get('account.invoice.discount_global.log')
+
+        instrumentation.add('invoices', len(invoices))
+        invoices = [i for i in invoices if not i.discount_global_computed]
+        # the rows are locked so concurrent computations of an invoice wait
+        # for each other instead of creating the lines twice
+        cls.lock(invoices)
+        existing = defaultdict(list)
+        for line in cls._get_discount_global_lines(invoices):
+            existing[line.invoice.id].append(line)
+        update_companies = cls._get_discount_global_update_companies(
+            {i.company for i in invoices if i.id in existing})
+
+        # invoices that already have a global discount line are skipped
+        # unless the company updates the line of draft invoices
+        to_compute = [i for i in invoices if i.id not in existing]
+        to_refresh = [i for i in invoices
+            if i.id in existing and i.state == 'draft'
+            and i.company in update_companies]
+        brackets = cls._get_discount_global_brackets(
+            [i for i in to_compute + to_refresh if not i.invoice_discount])
+        to_compute = [i for i in to_compute
+            if i.invoice_discount or i.id in brackets]
+        if not to_compute and not to_refresh:
+            return
+        per_tax_companies = cls._get_discount_global_per_tax_companies(
+            {i.company for i in to_compute + to_refresh})
+        per_tax = [i for i in to_compute + to_refresh
+            if i.company in per_tax_companies]
+        tax_bases = cls._get_discount_global_tax_bases(per_tax)
+        untaxed_amounts = cls._get_discount_global_bases(
+            [i for i in to_compute + to_refresh
+                if i.company not in per_tax_companies])
+        for invoice in per_tax:
+            untaxed_amounts[invoice.id] = sum(
+                tax_bases[invoice.id].values(),
+                invoice.currency.round(Decimal(0)))
 
         lines = []
         to_update = []
-        for invoice in invoices:
-            if not invoice.invoice_discount:
-                continue
-            discount_line = invoice._get_discount_global_line()
-            if discount_line:
-                lines.append(discount_line)
+        logs = []
+        tax_memo = {}
+        for invoice in to_compute:
+            untaxed_amount = untaxed_amounts[invoice.id]
+            rate = invoice._get_discount_global_rate(
+                untaxed_amount, brackets=brackets.get(invoice.id, NO_BRACKETS))
+            logs.append(invoice._get_discount_global_log(
+                    untaxed_amount, rate, tax_bases.get(invoice.id)))
+            if invoice.id in tax_bases:
+                discount_lines = invoice._get_discount_global_tax_lines(
+                    tax_bases[invoice.id],
+                    brackets=brackets.get(invoice.id, NO_BRACKETS))
+            else:
+                discount_lines = list(filter(None, [
+                            invoice._get_discount_global_line(
+                                untaxed_amount=untaxed_amounts[invoice.id],
+                                tax_memo=tax_memo,
+                                brackets=brackets.get(
+                                    invoice.id, NO_BRACKETS))]))
+            if discount_lines:
+                lines.extend(discount_lines)
+                to_update.append(invoice)
+
+        to_write = defaultdict(list)
+        to_delete = []
+        for invoice in to_refresh:
+            untaxed_amount = untaxed_amounts[invoice.id]
+            rate = invoice._get_discount_global_rate(
+                untaxed_amount, brackets=brackets.get(invoice.id, NO_BRACKETS))
+            logs.append(invoice._get_discount_global_log(
+                    untaxed_amount, rate, tax_bases.get(invoice.id)))
+            # the lines are matched by taxes when distributed per tax
+            current = {}
+            if invoice.id in tax_bases:
+                unit_prices = {
+                    taxes: round_price(-1 * base * rate)
+                    for taxes, base in tax_bases[invoice.id].items()}
+                for line in existing[invoice.id]:
+                    taxes = tuple(sorted(t.id for t in line.taxes))
+                    current.setdefault(taxes, []).append(line)
+            else:
+                unit_prices = {None: round_price(-1 * untaxed_amount * rate)}
+                current[None] = existing[invoice.id]
+            changed = False
+            for taxes, unit_price in unit_prices.items():
+                discount_line, *others = current.pop(taxes, [None])
+                if others:
+                    to_delete.extend(others)
+                    changed = True
+                if not unit_price:
+                    if discount_line:
+                        to_delete.append(discount_line)
+                        changed = True
+                elif not discount_line:
+                    lines.append(invoice._get_discount_global_tax_line(
+                            unit_price, taxes))
+                    changed = True
+                elif (discount_line.unit_price != unit_price
+                        # the lines copied by the credit notes are negated
+                        or discount_line.quantity != 1):
+                    to_write[unit_price].append(discount_line)
+                    changed = True
+            for others in current.values():
+                to_delete.extend(others)
+                changed = True
+            if changed:
                 to_update.append(invoice)
 
+        written = list(chain(*to_write.values()))
+        removed = cls._get_discount_global_lines_taxes(to_delete + written)
+        # the taxes of the discount lines are updated incrementally and the
+        # lines are deleted first as the new lines may have their taxes
+        if to_delete:
+            Line.delete(to_delete)
+        if to_write:
+            Line.write(*chain(*(
+                        (l, {'quantity': 1, 'unit_price': p})
+                        for p, l in to_write.items())))
         if lines:
             Line.create([x._save_values() for x in lines])
-        cls.update_taxes(to_update)
+        instrumentation.add(
+            'lines', len(lines) + len(written) + len(to_delete))
+        added = cls._get_discount_global_lines_taxes(
+            lines + Line.browse(written))
+        cls._update_discount_global_taxes(to_update, added, removed)
+        cls._set_discount_global_amounts(to_compute + to_refresh)
+        Log.insert(logs)
 
-    def _get_discount_global_line(self):
+    def _get_discount_global_log(self, untaxed_amount, rate, tax_bases=None):
+        """
+        Return the values of the log of the global discount computed for the
+        untaxed amount and the rate
+
+        The rounded amount is the sum of the unit prices of the lines, one per
+        base of tax_bases if given.
+        """
+        if tax_bases is None:
+            tax_bases = {None: untaxed_amount}
+        return {
+            'invoice': self.id,
+            'company': self.company.id,
+            'action': 'compute',
+            'base': untaxed_amount,
+            'rate': rate,
+            'amount': -1 * untaxed_amount * rate,
+            'rounded_amount': sum(
+                (round_price(-1 * b * rate) for b in tax_bases.values()),
+                Decimal(0)),
+            }
+
+    @classmethod
+    def _set_discount_global_amounts(cls, invoices):
+        """
+        Store on the invoices the amount deducted by their global discount
+        lines
+
+        The amounts are read from the lines table and only the invoices whose
+        amount changes are written.
+        """
         pool = Pool()
-        Config = pool.get('account.configuration')
         Line = pool.get('account.invoice.line')
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        amounts = {i.id: Decimal(0) for i in invoices}
+        currencies = {i.id: i.currency for i in invoices}
+        for sub_ids in grouped_slice(list(amounts)):
+            query = line.select(
+                line.invoice, line.quantity,
+                line.unit_price.as_('unit_price'),
+                where=reduce_ids(line.invoice, sub_ids)
+                & (line.type == 'line')
+                & (line.discount_global == Literal(True)))
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, [None, None, 'NUMERIC'])
+            cursor.execute(*query)
+            for invoice_id, quantity, unit_price in cursor:
+                amounts[invoice_id] -= currencies[invoice_id].round(
+                    Decimal(str(quantity or 0)) * (unit_price or Decimal(0)))
+
+        to_write = defaultdict(list)
+        for invoice in invoices:
+            if invoice.discount_global_amount != amounts[invoice.id]:
+                to_write[amounts[invoice.id]].append(invoice)
+        cls._write_discount_global_amounts(to_write)
 
+    @classmethod
+    def _write_discount_global_amounts(cls, amounts):
+        """
+        Update the global discount amount of the invoices grouped by amount
+
+        The column is updated directly as writing the invoices validates the
+        domain of the payment lines which computes the total amount from all
+        their lines.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        invoices = list(chain(*amounts.values()))
+        if not invoices:
+            return
+        for amount, sub_invoices in amounts.items():
+            for sub_ids in grouped_slice([i.id for i in sub_invoices]):
+                cursor.execute(*table.update(
+                        [table.discount_global_amount], [amount],
+                        where=reduce_ids(table.id, sub_ids)))
+        # clean the caches like ModelStorage does on write
+        transaction.counter += 1
+        for invoice in invoices:
+            invoice._local_cache.pop(invoice.id, None)
+        for cache in transaction.cache.values():
+            if cls.__name__ in cache:
+                for invoice in invoices:
+                    cache[cls.__name__].pop(invoice.id, None)
+
+    def _get_discount_global_taxes(self, lines):
+        """
+        Return the tax lines of the global discount lines by key of the
+        invoice taxes
+
+        Only the taxes of the given lines are computed and they are rounded
+        per line.
+        """
+        pool = Pool()
+        Tax = pool.get('account.tax')
+
+        taxes = {}
+        with Transaction().set_context(self._get_tax_context()):
+            for line in lines:
+                for line_taxes, unit_price, quantity, tax_date in (
+                        line.taxable_lines):
+                    current = {}
+                    for tax in Tax.compute(
+                            Tax.browse(line_taxes), unit_price, quantity,
+                            tax_date or self.tax_date):
+                        tax_line = self._compute_tax_line(**tax)
+                        if tax_line._key in current:
+                            current[tax_line._key] += tax_line
+                        else:
+                            current[tax_line._key] = tax_line
+                    self._round_taxes(current)
+                    for key, tax_line in current.items():
+                        if key in taxes:
+                            taxes[key] += tax_line
+                        else:
+                            taxes[key] = tax_line
+        return taxes
+
+    @classmethod
+    def _get_discount_global_lines_taxes(cls, lines):
+        "Return the tax lines of the global discount lines per invoice id"
+        invoices = {}
+        invoice_lines = defaultdict(list)
+        for line in lines:
+            invoices[line.invoice.id] = line.invoice
+            invoice_lines[line.invoice.id].append(line)
+        return {i: invoices[i]._get_discount_global_taxes(l)
+            for i, l in invoice_lines.items()}
+
+    @classmethod
+    def _update_discount_global_taxes(cls, invoices, added, removed):
+        """
+        Update the taxes of the invoices with the tax lines per invoice id of
+        the global discount lines added and removed
+
+        The taxes are updated incrementally instead of computing them from
+        all the lines of the invoices, so the taxes of the invoices must be up
+        to date before the discount lines change.
+        """
+        pool = Pool()
+        InvoiceTax = pool.get('account.invoice.tax')
+
+        to_create, to_write, to_delete = [], [], []
+        for invoice in invoices:
+            if invoice.state in {'posted', 'paid', 'cancelled'}:
+                continue
+            deltas = {}
+            for sign, tax_lines in [
+                    (1, added.get(invoice.id, {})),
+                    (-1, removed.get(invoice.id, {}))]:
+                for key, tax_line in tax_lines.items():
+                    base, amount = deltas.get(key, (0, 0))
+                    deltas[key] = (
+                        base + sign * tax_line.base,
+                        amount + sign * tax_line.amount)
+            invoice_taxes = {t._key: t for t in invoice.taxes if not t.manual}
+            for key, (base, amount) in deltas.items():
+                if not base and not amount:
+                    continue
+                account, tax, _ = key
+                invoice_tax = invoice_taxes.get(key)
+                if invoice_tax:
+                    base += invoice_tax.base
+                    amount += invoice_tax.amount
+                    if invoice.currency.is_zero(base):
+                        to_delete.append(invoice_tax)
+                    else:
+                        to_write.extend(([invoice_tax], {
+                                    'base': base,
+                                    'amount': amount,
+                                    }))
+                else:
+                    to_create.append({
+                            'invoice': invoice.id,
+                            'manual': False,
+                            'description': tax.description,
+                            'legal_notice': tax.legal_notice,
+                            'account': account.id,
+                            'tax': tax.id,
+                            'base': base,
+                            'amount': amount,
+                            })
+        if to_create:
+            InvoiceTax.create(to_create)
+        if to_delete:
+            InvoiceTax.delete(to_delete)
+        if to_write:
+            InvoiceTax.write(*to_write)
+
+    @classmethod
+    def _get_discount_global_update_companies(cls, companies):
+        """
+        Return the companies that keep the global discount line of draft
+        invoices and update it instead of creating a new one
+        """
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        config = Config(1)
+        return {c for c in companies
+            if config.get_multivalue('discount_global_update', company=c.id)}
+
+    @classmethod
+    def _get_discount_global_per_tax_companies(cls, companies):
+        """
+        Return the companies that distribute the global discount in one line
+        per group of taxes
+        """
+        pool = Pool()
+        Config = pool.get('account.configuration')
         config = Config(1)
-        product = config.discount_product
-        if not product:
+        return {c for c in companies
+            if config.get_multivalue('discount_global_per_tax', company=c.id)}
+
+    @classmethod
+    def _get_discount_global_brackets(cls, invoices):
+        "Return the non empty brackets of the party of each invoice"
+        pool = Pool()
+        Bracket = pool.get('party.invoice_discount.bracket')
+
+        parties = defaultdict(set)
+        for invoice in invoices:
+            parties[invoice.company.id, invoice.type].add(invoice.party.id)
+        company_brackets = {}
+        for (company, type_), party_ids in parties.items():
+            company_brackets[company, type_] = Bracket.get_brackets(
+                company, type_, party_ids)
+
+        brackets = {}
+        for invoice in invoices:
+            value = company_brackets[invoice.company.id, invoice.type][
+                invoice.party.id]
+            if value[0]:
+                brackets[invoice.id] = value
+        return brackets
+
+    def _get_discount_global_rate(self, untaxed_amount, brackets=None):
+        """
+        Return the global discount rate of the invoice for the untaxed amount
+
+        The invoice discount is used if set, otherwise the discount of the
+        party brackets, which are read if not given.
+        """
+        pool = Pool()
+        Bracket = pool.get('party.invoice_discount.bracket')
+        if self.invoice_discount:
+            return self.invoice_discount
+        if brackets is None:
+            brackets = self._get_discount_global_brackets([self]).get(
+                self.id, NO_BRACKETS)
+        return (Bracket.get_bracket_discount(
+                brackets, self._get_discount_global_bracket_amount(
+                    untaxed_amount))
+            or Decimal(0))
+
+    def _get_discount_global_bracket_amount(self, amount):
+        """
+        Return the amount converted to the currency of the company at the
+        currency date to be compared with the brackets
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        if self.currency == self.company.currency:
+            return amount
+        with Transaction().set_context(date=self.currency_date):
+            return Currency.compute(
+                self.currency, amount, self.company.currency, round=False)
+
+    @classmethod
+    def _get_discount_global_lines(cls, invoices):
+        "Return the global discount lines of the invoices"
+        pool = Pool()
+        Line = pool.get('account.invoice.line')
+
+        lines = []
+        for sub_invoices in grouped_slice(invoices):
+            lines.extend(Line.search([
+                        ('invoice', 'in', [i.id for i in sub_invoices]),
+                        ('discount_global', '=', True),
+                        ], order=[]))
+        return lines
+
+    @classmethod
+    def _get_discount_global_bases(cls, invoices):
+        """
+        Return a dictionary with the untaxed amount of each invoice without
+        its global discount lines
+
+        The amounts are aggregated with a query per page of lines grouped by
+        invoice, quantity and unit price so lines are not instantiated. Each
+        group is rounded like InvoiceLine.amount to get the same result as
+        untaxed_amount.
+        """
+        pool = Pool()
+        Line = pool.get('account.invoice.line')
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        bases = {}
+        to_compute = {}
+        for invoice in invoices:
+            bases[invoice.id] = invoice.currency.round(Decimal(0))
+            to_compute[invoice.id] = invoice
+
+        # the amount of supplier lines with non deductible taxes includes
+        # part of the taxes so it is computed from the instances
+        fallback = set()
+        for where in cls._get_discount_global_base_pages(
+                list(to_compute), line):
+            query = line.select(
+                line.invoice,
+                line.quantity.as_('quantity'),
+                line.unit_price.as_('unit_price'),
+                line.taxes_deductible_rate.as_('taxes_deductible_rate'),
+                Count(Literal('*')),
+                where=where,
+                group_by=[line.invoice, line.quantity, line.unit_price,
+                    line.taxes_deductible_rate])
+            if backend.name == 'sqlite':
+                sqlite_apply_types(
+                    query, [None, None, 'NUMERIC', 'NUMERIC', None])
+            cursor.execute(*query)
+            for invoice_id, quantity, unit_price, rate, count in cursor:
+                invoice = to_compute[invoice_id]
+                if (invoice.type == 'in'
+                        and rate is not None and rate != 1):
+                    fallback.add(invoice_id)
+                    continue
+                amount = (Decimal(str(quantity or 0))
+                    * (unit_price or Decimal(0)))
+                bases[invoice_id] += invoice.currency.round(amount) * count
+        for invoice_id in fallback:
+            bases[invoice_id] = to_compute[invoice_id].currency.round(
+                Decimal(0))
+        for base_line in cls._get_discount_global_base_lines(list(fallback)):
+            bases[base_line.invoice.id] += base_line.amount
+        return bases
+
+    @classmethod
+    def _get_discount_global_base_pages(cls, invoice_ids, line):
+        """
+        Yield the conditions on the line table selecting by pages the lines
+        of the invoices without their global discount lines
+
+        The invoices are grouped while their lines fit in a page and the lines
+        of larger invoices are paginated by id, so each page has a bounded
+        number of lines whatever the size of the invoices. The lines of the
+        excluded products are skipped.
+        """
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        size = transaction.database.IN_MAX
+
+        where = ((line.type == 'line')
+            & ((line.discount_global == Null)
+                | (line.discount_global == Literal(False))))
+        excluded = Config.get_discount_global_excluded_products()
+        if excluded:
+            where &= ((line.product == Null)
+                | ~reduce_ids(line.product, excluded))
+        counts = {}
+        for sub_ids in grouped_slice(invoice_ids):
+            cursor.execute(*line.select(
+                    line.invoice, Count(Literal('*')),
+                    where=reduce_ids(line.invoice, sub_ids) & where,
+                    group_by=[line.invoice]))
+            counts.update(cursor)
+
+        page, page_count = [], 0
+        for invoice_id in invoice_ids:
+            count = counts.get(invoice_id, 0)
+            if count > size:
+                last_id = None
+                while True:
+                    page_where = where & (line.invoice == invoice_id)
+                    if last_id is not None:
+                        page_where &= line.id > last_id
+                    cursor.execute(*line.select(line.id,
+                            where=page_where,
+                            order_by=[line.id.asc],
+                            limit=size))
+                    line_ids = [i for i, in cursor]
+                    if not line_ids:
+                        break
+                    yield where & reduce_ids(line.id, line_ids)
+                    last_id = line_ids[-1]
+            elif count:
+                if page_count + count > size:
+                    yield where & reduce_ids(line.invoice, page)
+                    page, page_count = [], 0
+                page.append(invoice_id)
+                page_count += count
+        if page:
+            yield where & reduce_ids(line.invoice, page)
+
+    @classmethod
+    def _get_discount_global_base_lines(cls, invoice_ids):
+        """
+        Yield the lines of the invoices without their global discount lines
+
+        The lines are instantiated by page.
+        """
+        pool = Pool()
+        Line = pool.get('account.invoice.line')
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for where in cls._get_discount_global_base_pages(invoice_ids, line):
+            cursor.execute(*line.select(line.id, where=where))
+            yield from Line.browse([i for i, in cursor])
+
+    @classmethod
+    def _get_discount_global_tax_bases(cls, invoices):
+        """
+        Return a dictionary with the untaxed amount of each invoice without
+        its global discount lines grouped by the sorted tuple of tax ids
+
+        The lines and their taxes are read with a query per page of lines so
+        lines are not instantiated. Each line is rounded like
+        InvoiceLine.amount.
+        """
+        pool = Pool()
+        Line = pool.get('account.invoice.line')
+        LineTax = pool.get('account.invoice.line-account.tax')
+        line = Line.__table__()
+        line_tax = LineTax.__table__()
+        cursor = Transaction().connection.cursor()
+
+        to_compute = {i.id: i for i in invoices}
+        bases = {i: defaultdict(Decimal) for i in to_compute}
+
+        # the amount of supplier lines with non deductible taxes includes
+        # part of the taxes so it is computed from the instances
+        fallback = set()
+        for where in cls._get_discount_global_base_pages(
+                list(to_compute), line):
+            query = line.join(line_tax, 'LEFT',
+                condition=line_tax.line == line.id
+                ).select(
+                    line.id, line.invoice,
+                    line.quantity.as_('quantity'),
+                    line.unit_price.as_('unit_price'),
+                    line.taxes_deductible_rate.as_('taxes_deductible_rate'),
+                    line_tax.tax,
+                    where=where)
+            if backend.name == 'sqlite':
+                sqlite_apply_types(
+                    query, [None, None, None, 'NUMERIC', 'NUMERIC', None])
+            cursor.execute(*query)
+            lines = {}
+            for line_id, invoice_id, quantity, unit_price, rate, tax in cursor:
+                invoice = to_compute[invoice_id]
+                if (invoice.type == 'in'
+                        and rate is not None and rate != 1):
+                    fallback.add(invoice_id)
+                if line_id not in lines:
+                    amount = invoice.currency.round(
+                        Decimal(str(quantity or 0))
+                        * (unit_price or Decimal(0)))
+                    lines[line_id] = (invoice_id, amount, set())
+                if tax is not None:
+                    lines[line_id][2].add(tax)
+            for invoice_id, amount, taxes in lines.values():
+                bases[invoice_id][tuple(sorted(taxes))] += amount
+        for invoice_id in fallback:
+            bases[invoice_id] = defaultdict(Decimal)
+        for base_line in cls._get_discount_global_base_lines(list(fallback)):
+            taxes = tuple(sorted(t.id for t in base_line.taxes))
+            bases[base_line.invoice.id][taxes] += base_line.amount
+        return {i: dict(b) for i, b in bases.items()}
+
+    def _get_discount_global_tax_lines(self, tax_bases, brackets=None):
+        """
+        Return the global discount lines of the invoice distributed by taxes
+        in proportion to the tax_bases returned by
+        _get_discount_global_tax_bases
+
+        The discount rate is computed from the total untaxed amount.
+        """
+        untaxed_amount = sum(tax_bases.values(), Decimal(0))
+        rate = self._get_discount_global_rate(
+            untaxed_amount, brackets=brackets)
+        lines = []
+        for taxes, base in tax_bases.items():
+            unit_price = round_price(-1 * base * rate)
+            if unit_price:
+                lines.append(
+                    self._get_discount_global_tax_line(unit_price, taxes))
+        return lines
+
+    def _get_discount_global_tax_line(
+            self, unit_price, taxes=None, tax_memo=None, product_values=None):
+        """
+        Return a global discount line of unit_price
+
+        The line gets the tax ids if not None, otherwise the taxes of the
+        discount product for the party. The product_values replace the values
+        of the discount product of the company if given.
+        """
+        pool = Pool()
+        Account = pool.get('account.account')
+        Config = pool.get('account.configuration')
+        Line = pool.get('account.invoice.line')
+        Product = pool.get('product.product')
+        Tax = pool.get('account.tax')
+        Uom = pool.get('product.uom')
+
+        values = product_values
+        if values is None:
+            values = Config.get_discount_product_values(
+                self.company, self.type)
+        if not values:
             raise UserError(gettext(
                 'account_invoice_discount_global.msg_missing_discount_product',
                 name=self.rec_name,
                 ))
+        line = Line()
+        line.invoice = self
+        line.type = 'line'
+        line.product = Product(values['product'])
+        line.account = Account(values['account']).current()
+        line.description = values['description']
+        line.quantity = 1
+        line.unit = Uom(values['unit'])
+        line.unit_price = unit_price
+        line.sequence = 9999
+        line.discount_global = True
+        if taxes is not None:
+            line.taxes = Tax.browse(taxes)
+        else:
+            line._update_taxes(self.type, self.party, tax_memo=tax_memo)
+        line.discount_global_taxes = Line.get_discount_global_taxes(
+            line.taxes)
+        return line
 
-        # check invoice has a global discount line; not create a new line
-        for line in self.lines:
-            if (line.type == 'line' and line.product
-                    and line.product.id == product.id):
-                return
+    @instrumented('_get_discount_global_line')
+    def _get_discount_global_line(
+            self, untaxed_amount=None, tax_memo=None, brackets=None):
+        pool = Pool()
+        Config = pool.get('account.configuration')
 
-        amount = -1 * self.untaxed_amount * self.invoice_discount
+        instrumentation.add('invoices', 1)
+        values = Config.get_discount_product_values(self.company, self.type)
+        if not values:
+            raise UserError(gettext(
+                'account_invoice_discount_global.msg_missing_discount_product',
+                name=self.rec_name,
+                ))
+
+        if untaxed_amount is None:
+            untaxed_amount = self._get_discount_global_bases([self])[self.id]
+        amount = -1 * untaxed_amount * self._get_discount_global_rate(
+            untaxed_amount, brackets=brackets)
         if amount:
-            line = Line()
-            line.invoice = self
-            line.type = 'line'
-            line.product = product
-            if self.type == 'in':
-                line.account = product.account_expense_used
-            else:
-                line.account = product.account_revenue_used
-            line.description = product.rec_name
-            line.quantity = 1
-            line.unit = product.default_uom
-            line.unit_price = round_price(amount)
-            line.sequence = 9999
-            line._update_taxes(self.type, self.party)
+            line = self._get_discount_global_tax_line(
+                round_price(amount), tax_memo=tax_memo)
+            instrumentation.add('lines', 1)
             return line
 
     @classmethod
-    def remove_discount_global(cls, invoices):
+    def simulate_discount_global(cls, invoices, rate=None, product=None):
+        """
+        Return the global discount that compute_discount_global would apply
+        to each invoice without saving anything
+
+        The result is a list of dictionaries with the id of the invoice, the
+        base, the rate, the amount deducted like discount_global_amount, the
+        tax amount and the taxes of the global discount lines as a list of
+        dictionaries with the tax, the base and the amount.
+        The rate and the product id, if given, replace the rate of the
+        invoices and the discount product of the company. The bases are read
+        in batch and the lines are only instantiated.
+        """
         pool = Pool()
-        Line = pool.get('account.invoice.line')
         Config = pool.get('account.configuration')
+        Product = pool.get('product.product')
+        Tax = pool.get('account.tax')
 
-        config = Config(1)
-        product = config.discount_product
-        if not product:
-            return
+        if rate is not None:
+            rate = Decimal(str(rate))
+            brackets = {}
+        else:
+            brackets = cls._get_discount_global_brackets(
+                [i for i in invoices if not i.invoice_discount])
+        if product is not None:
+            product = Product(product)
+        per_tax_companies = cls._get_discount_global_per_tax_companies(
+            {i.company for i in invoices})
+        tax_bases = cls._get_discount_global_tax_bases(
+            [i for i in invoices if i.company in per_tax_companies])
+        untaxed_amounts = cls._get_discount_global_bases(
+            [i for i in invoices if i.company not in per_tax_companies])
+        for invoice_id, bases in tax_bases.items():
+            untaxed_amounts[invoice_id] = sum(bases.values(), Decimal(0))
 
-        to_delete = []
-        to_update_taxes = []
+        result = []
+        product_values = {}
+        tax_memo = {}
         for invoice in invoices:
-            if invoice.state in ('cancelled', 'posted', 'paid'):
-                continue
-            for line in invoice.lines:
-                if (line.type == 'line' and line.product
-                        and line.product.id == product.id):
-                    to_delete.append(line)
-                    to_update_taxes.append(invoice)
-                    break
+            untaxed_amount = untaxed_amounts[invoice.id]
+            invoice_rate = rate
+            if invoice_rate is None:
+                invoice_rate = invoice._get_discount_global_rate(
+                    untaxed_amount,
+                    brackets=brackets.get(invoice.id, NO_BRACKETS))
+            if product is not None:
+                key = (invoice.company.id, invoice.type)
+                if key not in product_values:
+                    # the accounts of the product depend on the company
+                    with Transaction().set_context(
+                            company=invoice.company.id):
+                        product_values[key] = (
+                            Config._get_discount_product_values(
+                                Product(product.id), invoice.type))
+                values = product_values[key]
+            else:
+                values = None
 
+            amount = Decimal(0)
+            taxes = defaultdict(lambda: [Decimal(0), Decimal(0)])
+            for line_taxes, base in tax_bases.get(
+                    invoice.id, {None: untaxed_amount}).items():
+                unit_price = round_price(-1 * base * invoice_rate)
+                if not unit_price:
+                    continue
+                line = invoice._get_discount_global_tax_line(
+                    unit_price, line_taxes, tax_memo=tax_memo,
+                    product_values=values)
+                amount -= invoice.currency.round(unit_price)
+                with Transaction().set_context(invoice._get_tax_context()):
+                    for tax in Tax.compute(
+                            line.taxes, unit_price, 1, invoice.tax_date):
+                        taxes[tax['tax'].id][0] += invoice.currency.round(
+                            tax['base'])
+                        taxes[tax['tax'].id][1] += invoice.currency.round(
+                            tax['amount'])
+            result.append({
+                    'id': invoice.id,
+                    'base': untaxed_amount,
+                    'rate': invoice_rate,
+                    'amount': amount,
+                    'tax_amount': sum(
+                        (a for _, a in taxes.values()), Decimal(0)),
+                    'taxes': [{
+                            'tax': t,
+                            'base': b,
+                            'amount': a,
+                            } for t, (b, a) in taxes.items()],
+                    })
+        return result
+
+    @classmethod
+    @instrumented('remove_discount_global')
+    def remove_discount_global(cls, invoices):
+        instrumentation.add('invoices', len(invoices))
+        invoices = [i for i in invoices
+            if i.state not in ('cancelled', 'posted', 'paid')]
+        # the line is updated by compute_discount_global
+        update_companies = cls._get_discount_global_update_companies(
+            {i.company for i in invoices})
+        invoices = [i for i in invoices if i.company not in update_companies]
+        cls._remove_discount_global(invoices)
+
+    @classmethod
+    def _remove_discount_global(cls, invoices):
+        "Remove the global discount lines of the invoices"
+        pool = Pool()
+        Line = pool.get('account.invoice.line')
+        Log = pool.get('account.invoice.discount_global.log')
+
+        cls.lock(invoices)
+        to_delete = cls._get_discount_global_lines(invoices)
+        instrumentation.add('lines', len(to_delete))
         if to_delete:
+            amounts = defaultdict(Decimal)
+            for line in to_delete:
+                amounts[line.invoice] += round_price(
+                    Decimal(str(line.quantity or 0))
+                    * (line.unit_price or Decimal(0)))
+            computations = Log.get_last_computations(list(amounts))
+            removed = cls._get_discount_global_lines_taxes(to_delete)
             Line.delete(to_delete)
-        if to_update_taxes:
-            cls.update_taxes(to_update_taxes)
+            cls._update_discount_global_taxes(list(amounts), {}, removed)
+            logs = []
+            for invoice, amount in amounts.items():
+                log = {
+                    'invoice': invoice.id,
+                    'company': invoice.company.id,
+                    'action': 'remove',
+                    'rounded_amount': amount,
+                    }
+                log.update(computations.get(invoice.id, {}))
+                logs.append(log)
+            Log.insert(logs)
+        cls._write_discount_global_amounts({
+                Decimal(0): [i for i in invoices if i.discount_global_amount],
+                })
 
     def _credit(self, **values):
         credit = super(Invoice, self)._credit(**values)
         credit.invoice_discount = self.invoice_discount
+        # the negated global discount lines are copied by the lines
+        credit.discount_global_computed = self.state in {
+            'validated', 'posted', 'paid'}
+        if credit.discount_global_computed:
+            credit.discount_global_amount = -self.discount_global_amount
         return credit
 
+    @classmethod
+    def credit(cls, invoices, refund=False, **values):
+        with Transaction().set_context(_discount_global_credit=True):
+            return super(Invoice, cls).credit(
+                invoices, refund=refund, **values)
+
+    @classmethod
+    def copy(cls, invoices, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('discount_global_computed', False)
+        return super(Invoice, cls).copy(invoices, default=default)
+
     @classmethod
     @ModelView.button
     @Workflow.transition('validated')
@@ -138,10 +1314,210 @@ class Invoice(metaclass=PoolMeta):
         cls.compute_discount_global(invoices)
         super(Invoice, cls).post(invoices)
 
+    @classmethod
+    def post_queue(cls, invoices):
+        """
+        Enqueue the posting of the invoices in chunks and return the number of
+        invoices enqueued
+
+        Each chunk computes its global discounts and is posted in its own
+        transaction by the queue worker or after the request without it.
+        The access to the post button is checked before as the queue calls
+        post without checking it.
+        """
+        size = cls._get_queue_chunk_size()
+        invoices = cls._check_post_button(invoices)
+        invoices = [i for i in invoices if i.state in {'draft', 'validated'}]
+        for sub_invoices in grouped_slice(invoices, count=size):
+            cls.__queue__.post(list(sub_invoices))
+        return len(invoices)
+
+    @classmethod
+    def _check_post_button(cls, invoices):
+        """
+        Check the access to the post button like ModelView.button and return
+        the invoices which pass its rules
+
+        The clicks are neither registered nor reset as the invoices are
+        posted later by the queue, so the rules are tested with the existing
+        clicks and one of the user.
+        """
+        pool = Pool()
+        Button = pool.get('ir.model.button')
+        ButtonClick = pool.get('ir.model.button.click')
+        ModelAccess = pool.get('ir.model.access')
+        User = pool.get('res.user')
+        transaction = Transaction()
+
+        if transaction.user == 0 or not transaction.check_access:
+            return invoices
+        ModelAccess.check(cls.__name__, 'read')
+        # check the record rules
+        cls.read([i.id for i in invoices], ['id'])
+        button_groups = Button.get_groups(cls.__name__, 'post')
+        if button_groups:
+            if not set(User.get_groups()) & button_groups:
+                raise AccessButtonError(
+                    gettext('ir.msg_access_button_error',
+                        button='post', model=cls.__name__))
+        else:
+            ModelAccess.check(cls.__name__, 'write')
+
+        button_rules = Button.get_rules(cls.__name__, 'post')
+        if button_rules:
+            clicks = defaultdict(list)
+            with without_check_access():
+                for sub_invoices in grouped_slice(invoices):
+                    for click in ButtonClick.search([
+                                ('button.model.name', '=', cls.__name__),
+                                ('button.name', '=', 'post'),
+                                ('record_id', 'in',
+                                    [i.id for i in sub_invoices]),
+                                ], order=[]):
+                        clicks[click.record_id].append(click)
+            click = ButtonClick(user=User(transaction.user))
+            invoices = [i for i in invoices
+                if all(r.test(i, clicks[i.id] + [click])
+                    for r in button_rules)]
+        return invoices
+
+    @classmethod
+    def lock_skip_locked(cls, invoices):
+        """
+        Return the invoices whose rows are not locked by another transaction
+        and lock them
+
+        It allows parallel jobs to process the other invoices instead of
+        waiting. The rows locked by SKIP LOCKED are registered as locked by
+        the transaction so the next locks do not restart the request. Without
+        SELECT FOR support, all the invoices are locked.
+        """
+        transaction = Transaction()
+        database = transaction.database
+        if database.has_select_for():
+            table = cls.__table__()
+            cursor = transaction.connection.cursor()
+            For = database.get_select_for_skip_locked()
+            ids = set()
+            for sub_invoices in grouped_slice(invoices):
+                cursor.execute(*table.select(table.id,
+                        where=reduce_ids(
+                            table.id, [i.id for i in sub_invoices]),
+                        for_=For('UPDATE')))
+                ids.update(i for i, in cursor)
+            cls._register_locked(ids)
+            invoices = [i for i in invoices if i.id in ids]
+        cls.lock(invoices)
+        return invoices
+
+    @classmethod
+    def _register_locked(cls, ids):
+        """
+        Register the ids of the rows locked by a query of the transaction so
+        ModelSQL.lock does not restart the transaction to lock them again
+
+        It relies on the internal _locked_records of the trytond 7.8
+        Transaction, which ModelSQL.lock checks before raising a
+        TransactionError, and must be updated with it.
+        """
+        Transaction()._locked_records[cls._table].update(ids)
+
+    @classmethod
+    def _get_queue_chunk_size(cls):
+        "Return the number of invoices processed by each queue task"
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        configuration = Config(1)
+        return (configuration.post_queue_size
+            or config.getint('queue', 'batch_size', default=20))
+
+    @classmethod
+    def update_draft_invoice_discounts(cls):
+        """
+        Enqueue in chunks the update of the draft invoices whose invoice
+        discount is not the discount of their party at their date and return
+        the number of invoices enqueued
+
+        The invoices of the context company are checked or of all the
+        companies without context company. The credit notes which keep the
+        global discount of the credited invoice are not updated.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        company_id = Transaction().context.get('company')
+        if company_id is not None:
+            companies = [Company(company_id)]
+        else:
+            companies = Company.search([])
+        size = cls._get_queue_chunk_size()
+
+        count = 0
+        for company in companies:
+            invoices = cls.search([
+                    ('company', '=', company.id),
+                    ('state', '=', 'draft'),
+                    ('party', '!=', None),
+                    ('discount_global_computed', '=', False),
+                    ], order=[('id', 'ASC')])
+            to_update = []
+            for sub_invoices in grouped_slice(invoices):
+                sub_invoices = list(sub_invoices)
+                discounts = cls.get_party_invoice_discounts(
+                    {(i.party.id, company.id, i.type, i.invoice_date)
+                        for i in sub_invoices})
+                for invoice in sub_invoices:
+                    discount = discounts[invoice.party.id, company.id,
+                        invoice.type, invoice.invoice_date]
+                    if ((invoice.invoice_discount or Decimal(0))
+                            != (discount or Decimal(0))):
+                        to_update.append(invoice)
+            for sub_invoices in grouped_slice(to_update, count=size):
+                cls.__queue__.update_invoice_discounts(list(sub_invoices))
+            count += len(to_update)
+        return count
+
+    @classmethod
+    def update_invoice_discounts(cls, invoices):
+        """
+        Set the discount of the party at their date on the draft invoices and
+        refresh their global discount lines
+
+        The invoices locked by another transaction are skipped and updated by
+        the next run.
+        """
+        invoices = cls.lock_skip_locked(
+            [i for i in invoices if i.state == 'draft' and i.party
+                and not i.discount_global_computed])
+        discounts = cls.get_party_invoice_discounts(
+            {(i.party.id, i.company.id, i.type, i.invoice_date)
+                for i in invoices})
+        to_write = defaultdict(list)
+        for invoice in invoices:
+            discount = (discounts[invoice.party.id, invoice.company.id,
+                    invoice.type, invoice.invoice_date] or Decimal(0))
+            if invoice.invoice_discount != discount:
+                to_write[discount].append(invoice)
+        if not to_write:
+            return
+        cls.write(*chain(*(
+                    (i, {'invoice_discount': d})
+                    for d, i in to_write.items())))
+
+        updated = list(chain(*to_write.values()))
+        to_refresh = cls.browse(list(
+                {l.invoice.id for l in cls._get_discount_global_lines(
+                        updated)}))
+        if to_refresh:
+            cls.remove_discount_global(to_refresh)
+            cls.compute_discount_global(to_refresh)
+
     @classmethod
     @ModelView.button
     @Workflow.transition('draft')
     def draft(cls, invoices):
+        # lock before any change as the lock may restart the request
+        cls.lock(invoices)
         super(Invoice, cls).draft(invoices)
         cls.remove_discount_global(invoices)
 
@@ -149,62 +1525,736 @@ class Invoice(metaclass=PoolMeta):
     @ModelView.button
     @Workflow.transition('cancelled')
     def cancel(cls, invoices):
+        cls.lock(invoices)
+        # the lines are removed also for the companies which update them as
+        # the invoices can not be modified once cancelled
+        cls._remove_discount_global(
+            [i for i in invoices if i.state in {'draft', 'validated'}])
         super(Invoice, cls).cancel(invoices)
-        cls.remove_discount_global(invoices)
 
 
 class InvoiceLine(metaclass=PoolMeta):
     __name__ = 'account.invoice.line'
+    discount_global = fields.Boolean("Global Discount", readonly=True,
+        help="The line was generated by the invoice global discount.")
+    discount_global_taxes = fields.Char(
+        "Global Discount Taxes", readonly=True,
+        help="The taxes of the global discount line when it was generated.")
+
+    @classmethod
+    def __setup__(cls):
+        super(InvoiceLine, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.invoice, Index.Range()),
+                    where=t.discount_global == Literal(True)),
+                Index(t, (t.invoice, Index.Range()), (t.id, Index.Range())),
+                })
+        cls._sql_constraints += [
+            ('discount_global_unique',
+                Exclude(t, (t.invoice, Equal),
+                    (t.discount_global_taxes, Equal),
+                    where=t.discount_global == Literal(True)),
+                'account_invoice_discount_global.'
+                'msg_invoice_line_discount_global_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        ConfigDiscountProduct = pool.get(
+            'account.configuration.discount_product')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table_handler__(module_name)
+        sql_table = cls.__table__()
+        config = ConfigDiscountProduct.__table__()
+
+        created_discount_global = not table.column_exist('discount_global')
+
+        super(InvoiceLine, cls).__register__(module_name)
+
+        # Migration from 7.8: flag the lines of the discount product
+        if created_discount_global:
+            cursor.execute(*sql_table.update(
+                    [sql_table.discount_global], [Literal(True)],
+                    where=(sql_table.type == 'line')
+                    & sql_table.product.in_(config.select(
+                            config.discount_product,
+                            where=config.discount_product != Null))))
+
+    @staticmethod
+    def default_discount_global():
+        return False
 
-    def _update_taxes(self, invoice_type, party):
+    @classmethod
+    def get_discount_global_taxes(cls, taxes):
+        "Return the key of the global discount line with the taxes"
+        return ','.join(map(str, sorted(t.id for t in taxes)))
+
+    @fields.depends('discount_global', 'taxes')
+    def on_change_product(self):
+        # the taxes of global discount lines are set when they are computed
+        # and may be distributed per tax
+        taxes = list(self.taxes or []) if self.discount_global else None
+        super(InvoiceLine, self).on_change_product()
+        if taxes is not None:
+            self.taxes = taxes
+
+    @instrumented('InvoiceLine._update_taxes')
+    def _update_taxes(self, invoice_type, party, tax_memo=None):
+        """
+        Set the taxes of the product applying the party tax rule
+
+        The resulting taxes are stored in tax_memo, if given, by tax rule,
+        product, invoice type and pattern so the rule is applied only once
+        for each combination.
+        """
         Tax = Pool().get('account.tax')
-        taxes = []
         pattern = self._get_tax_rule_pattern()
         if invoice_type == 'in':
-            for tax in self.product.supplier_taxes_used:
-                if party.supplier_tax_rule:
-                    tax_ids = party.supplier_tax_rule.apply(tax, pattern)
-                    if tax_ids:
-                        taxes.extend(tax_ids)
-                    continue
-                taxes.append(tax.id)
-            if party.supplier_tax_rule:
-                tax_ids = party.supplier_tax_rule.apply(None, pattern)
-                if tax_ids:
-                    taxes.extend(tax_ids)
+            tax_rule = party.supplier_tax_rule
+        else:
+            tax_rule = party.customer_tax_rule
+        key = (tax_rule.id if tax_rule else None, self.product.id,
+            invoice_type, freeze(pattern))
+        instrumentation.add('lines', 1)
+        if tax_memo is not None:
+            instrumentation.cache('tax_rule', key in tax_memo)
+        if tax_memo is not None and key in tax_memo:
+            taxes = tax_memo[key]
         else:
-            for tax in self.product.customer_taxes_used:
-                if party.customer_tax_rule:
-                    tax_ids = party.customer_tax_rule.apply(tax, pattern)
+            taxes = []
+            if invoice_type == 'in':
+                product_taxes = self.product.supplier_taxes_used
+            else:
+                product_taxes = self.product.customer_taxes_used
+            for tax in product_taxes:
+                if tax_rule:
+                    tax_ids = tax_rule.apply(tax, pattern)
                     if tax_ids:
                         taxes.extend(tax_ids)
                     continue
                 taxes.append(tax.id)
-            if party.customer_tax_rule:
-                tax_ids = party.customer_tax_rule.apply(None, pattern)
+            if tax_rule:
+                tax_ids = tax_rule.apply(None, pattern)
                 if tax_ids:
                     taxes.extend(tax_ids)
+            if tax_memo is not None:
+                tax_memo[key] = taxes
         if taxes:
             self.taxes = Tax.browse(taxes)
 
+    def _credit(self):
+        line = super(InvoiceLine, self)._credit()
+        line.discount_global = self.discount_global
+        line.discount_global_taxes = self.discount_global_taxes
+        return line
+
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        super(InvoiceLine, cls).on_modification(
+            mode, lines, field_names=field_names)
+        # the global discount must be computed again when the amounts of the
+        # lines of a draft credit note change
+        if (not Transaction().context.get('_discount_global_credit')
+                and (mode != 'write' or field_names is None
+                    or field_names & {
+                        'quantity', 'unit_price', 'taxes', 'type'})):
+            invoices = {l.invoice for l in lines
+                if l.invoice and l.invoice.state == 'draft'
+                and l.invoice.discount_global_computed}
+            if invoices:
+                Invoice.write(list(invoices), {
+                        'discount_global_computed': False,
+                        })
+
 
-class Sale(metaclass=PoolMeta):
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.append(
+            ('account.invoice|update_draft_invoice_discounts',
+                "Update Draft Invoice Discounts"))
+
+
+class PostQueue(Wizard):
+    "Post Invoices in Background"
+    __name__ = 'account.invoice.post_queue'
+    start = StateTransition()
+    done = StateView('account.invoice.post_queue.done',
+        'account_invoice_discount_global.invoice_post_queue_done_view_form', [
+            Button("OK", 'end', 'tryton-ok', default=True),
+            ])
+
+    def transition_start(self):
+        self.done.count = self.model.post_queue(self.records)
+        return 'done'
+
+    def default_done(self, fields):
+        return {
+            'count': self.done.count,
+            }
+
+
+class PostQueueDone(ModelView):
+    "Post Invoices in Background"
+    __name__ = 'account.invoice.post_queue.done'
+    count = fields.Integer("Enqueued Invoices", readonly=True)
+
+
+class DiscountGlobalAnalysis(ModelSQL, ModelView):
+    "Invoice Global Discount Analysis"
+    __name__ = 'account.invoice.discount_global.analysis'
+    company = fields.Many2One('company.company', "Company", readonly=True)
+    party = fields.Many2One('party.party', "Party", readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    type = fields.Selection([
+            ('out', "Customer"),
+            ('in', "Supplier"),
+            ], "Type", readonly=True)
+    period = fields.Many2One('account.period', "Period", readonly=True)
+    currency = fields.Many2One('currency.currency', "Currency", readonly=True)
+    amount = Monetary(
+        "Global Discount", digits='currency', currency='currency',
+        readonly=True)
+    base = Monetary(
+        "Base", digits='currency', currency='currency', readonly=True,
+        help="The untaxed amount before the global discount.")
+    count = fields.Integer("Invoices", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(DiscountGlobalAnalysis, cls).__setup__()
+        cls._order.insert(0, ('period', 'DESC'))
+        cls._order.insert(1, ('party', 'ASC'))
+
+    @classmethod
+    def table_query(cls):
+        """
+        Return the sums of the stored global discount and untaxed amounts of
+        the posted invoices grouped by company, party, type, period and
+        currency
+
+        The discount lines are not read and the invoices are filtered by the
+        company, the type and the periods of the context.
+        """
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        invoice = Invoice.__table__()
+        move = Move.__table__()
+        period = Period.__table__()
+        context = Transaction().context
+
+        amount = invoice.discount_global_amount
+        if backend.name == 'sqlite':
+            amount = Cast(
+                amount, Invoice.discount_global_amount.sql_type().base)
+        where = ((invoice.company == context.get('company'))
+            & invoice.state.in_(['posted', 'paid'])
+            & (amount != Literal(0)))
+        if context.get('type'):
+            where &= invoice.type == context['type']
+        if context.get('fiscalyear'):
+            where &= period.fiscalyear == context['fiscalyear']
+        if context.get('start_period'):
+            start_period = Period(context['start_period'])
+            where &= period.start_date >= start_period.start_date
+        if context.get('end_period'):
+            end_period = Period(context['end_period'])
+            where &= period.start_date <= end_period.start_date
+
+        return (invoice
+            .join(move, condition=invoice.move == move.id)
+            .join(period, condition=move.period == period.id)
+            .select(
+                Min(invoice.id).as_('id'),
+                invoice.company.as_('company'),
+                invoice.party.as_('party'),
+                invoice.type.as_('type'),
+                move.period.as_('period'),
+                invoice.currency.as_('currency'),
+                Sum(invoice.discount_global_amount).as_('amount'),
+                Sum(invoice.untaxed_amount_cache
+                    + invoice.discount_global_amount).as_('base'),
+                Count(Literal('*')).as_('count'),
+                where=where,
+                group_by=[invoice.company, invoice.party, invoice.type,
+                    move.period, invoice.currency]))
+
+
+class DiscountGlobalAnalysisContext(ModelView):
+    "Invoice Global Discount Analysis Context"
+    __name__ = 'account.invoice.discount_global.analysis.context'
+    company = fields.Many2One('company.company', "Company", required=True)
+    fiscalyear = fields.Many2One('account.fiscalyear', "Fiscal Year",
+        domain=[
+            ('company', '=', Eval('company', -1)),
+            ])
+    start_period = fields.Many2One('account.period', "Start Period",
+        domain=[
+            ('company', '=', Eval('company', -1)),
+            If(Eval('fiscalyear'),
+                ('fiscalyear', '=', Eval('fiscalyear', -1)),
+                ()),
+            If(Eval('end_period'),
+                ('start_date', '<=', (Eval('end_period'), 'start_date')),
+                ()),
+            ])
+    end_period = fields.Many2One('account.period', "End Period",
+        domain=[
+            ('company', '=', Eval('company', -1)),
+            If(Eval('fiscalyear'),
+                ('fiscalyear', '=', Eval('fiscalyear', -1)),
+                ()),
+            If(Eval('start_period'),
+                ('start_date', '>=', (Eval('start_period'), 'start_date')),
+                ()),
+            ])
+    type = fields.Selection([
+            (None, ""),
+            ('out', "Customer"),
+            ('in', "Supplier"),
+            ], "Type")
+
+    @classmethod
+    def default_company(cls):
+        return Transaction().context.get('company')
+
+    @classmethod
+    def default_fiscalyear(cls):
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        context = Transaction().context
+        if 'fiscalyear' in context:
+            return context['fiscalyear']
+        try:
+            fiscalyear = FiscalYear.find(
+                context.get('company'), test_state=False)
+        except FiscalYearNotFoundError:
+            return None
+        return fiscalyear.id
+
+    @classmethod
+    def default_start_period(cls):
+        return Transaction().context.get('start_period')
+
+    @classmethod
+    def default_end_period(cls):
+        return Transaction().context.get('end_period')
+
+    @classmethod
+    def default_type(cls):
+        return Transaction().context.get('type')
+
+    @fields.depends('company', 'fiscalyear')
+    def on_change_company(self):
+        if self.fiscalyear and self.fiscalyear.company != self.company:
+            self.fiscalyear = None
+            self.start_period = self.end_period = None
+
+    @fields.depends('fiscalyear', 'start_period', 'end_period')
+    def on_change_fiscalyear(self):
+        if not self.fiscalyear:
+            return
+        if (self.start_period
+                and self.start_period.fiscalyear != self.fiscalyear):
+            self.start_period = None
+        if (self.end_period
+                and self.end_period.fiscalyear != self.fiscalyear):
+            self.end_period = None
+
+
+class DiscountGlobalLog(ModelSQL, ModelView):
+    "Invoice Global Discount Log"
+    __name__ = 'account.invoice.discount_global.log'
+    invoice = fields.Many2One('account.invoice', "Invoice", required=True,
+        readonly=True, ondelete='CASCADE')
+    company = fields.Many2One('company.company', "Company", required=True,
+        readonly=True)
+    action = fields.Selection([
+            ('compute', "Compute"),
+            ('remove', "Remove"),
+            ], "Action", required=True, readonly=True)
+    base = fields.Numeric("Base", readonly=True,
+        help="The untaxed amount of the invoice without its global discount "
+        "lines.")
+    rate = fields.Numeric("Rate", digits=price_digits, readonly=True)
+    amount = fields.Numeric("Amount", readonly=True,
+        help="The global discount before rounding.")
+    rounded_amount = fields.Numeric("Rounded Amount", digits=price_digits,
+        readonly=True,
+        help="The sum of the unit prices of the global discount lines.")
+
+    @classmethod
+    def __setup__(cls):
+        super(DiscountGlobalLog, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.invoice, Index.Range()), (t.id, Index.Range())))
+        cls._order = [
+            ('create_date', 'DESC'),
+            ('id', 'DESC'),
+            ]
+
+    @classmethod
+    def check_modification(cls, mode, records, values=None, external=False):
+        super(DiscountGlobalLog, cls).check_modification(
+            mode, records, values=values, external=external)
+        # the entries are only deleted with their invoice
+        if mode == 'write' or external:
+            raise AccessError(gettext(
+                    'account_invoice_discount_global.msg_discount_global_log'))
+
+    @classmethod
+    def get_last_computations(cls, invoices):
+        """
+        Return a dictionary with the base, the rate and the amount of the last
+        entry of each invoice if it is a computation
+
+        The removed lines of the other invoices were not created by a logged
+        computation, like the lines copied from the credited invoices.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        last = cls.__table__()
+
+        computations = {}
+        for sub_invoices in grouped_slice(invoices):
+            query = table.select(
+                table.invoice,
+                table.base.as_('base'),
+                table.rate.as_('rate'),
+                table.amount.as_('amount'),
+                where=(table.action == 'compute')
+                & table.id.in_(last.select(Max(last.id),
+                        where=reduce_ids(
+                            last.invoice, [i.id for i in sub_invoices]),
+                        group_by=last.invoice)))
+            if backend.name == 'sqlite':
+                sqlite_apply_types(
+                    query, [None, 'NUMERIC', 'NUMERIC', 'NUMERIC'])
+            cursor.execute(*query)
+            for invoice_id, base, rate, amount in cursor:
+                computations[invoice_id] = {
+                    'base': base,
+                    'rate': rate,
+                    'amount': amount,
+                    }
+        return computations
+
+    @classmethod
+    def insert(cls, vlist):
+        """
+        Append the log entries of the values in vlist
+
+        The rows are inserted with a single query, or a query per group of
+        rows if they do not fit in one, without instantiating the records.
+        The entries get the user and the time of the transaction.
+        """
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        if not vlist:
+            return
+
+        names = ['invoice', 'company', 'action', 'base', 'rate', 'amount',
+            'rounded_amount']
+        columns = [table.create_uid, table.create_date] + [
+            Column(table, n) for n in names]
+        if database.has_multirow_insert():
+            size = database.IN_MAX // len(columns)
+        else:
+            size = 1
+        rows = ([transaction.user, CurrentTimestamp()]
+            + [cls._fields[n].sql_format(v.get(n)) for n in names]
+            for v in vlist)
+        for sub_rows in grouped_slice(rows, size):
+            cursor.execute(*table.insert(columns, list(sub_rows)))
+
+
+class DiscountGlobalPreviewMixin:
+    __slots__ = ()
+    discount_global_amount = fields.Function(Monetary(
+            "Global Discount", digits='currency', currency='currency',
+            help="The global discount of the invoice party."),
+        'get_discount_global_amounts')
+    discount_global_total_amount = fields.Function(Monetary(
+            "Total after Global Discount", digits='currency',
+            currency='currency',
+            help="The total amount reduced by the global discount of the "
+            "invoice party."),
+        'get_discount_global_amounts')
+
+    @classmethod
+    def get_discount_global_amounts(cls, records, names):
+        """
+        Return the global discount and the discounted total of the records
+
+        The amounts come from get_amount which uses the stored amount caches
+        minus the amount of the lines of the excluded products and the rates
+        of all the parties are read at once. Like on the invoice, the total
+        is the discounted untaxed amount plus the tax amount reduced by the
+        rounded discount of the taxes and the discount is rounded per group
+        of taxes for the companies which distribute it per tax.
+        """
+        pool = Pool()
+        Bracket = pool.get('party.invoice_discount.bracket')
+        Invoice = pool.get('account.invoice')
+        type_ = cls._discount_global_invoice_type
+
+        amounts = cls.get_amount(records, ['untaxed_amount', 'tax_amount'])
+        parties = {r.id: r._get_discount_global_party() for r in records}
+        records = [r for r in records if parties[r.id]]
+        keys = {r.id: (parties[r.id].id, r.company.id, type_, None)
+            for r in records}
+        rates = Invoice.get_party_invoice_discounts(set(keys.values()))
+        to_bracket = defaultdict(set)
+        for record in records:
+            if not rates[keys[record.id]]:
+                to_bracket[record.company.id].add(parties[record.id].id)
+        brackets = {}
+        for company, party_ids in to_bracket.items():
+            for party, value in Bracket.get_brackets(
+                    company, type_, party_ids).items():
+                brackets[company, party] = value
+        per_tax_companies = Invoice._get_discount_global_per_tax_companies(
+            {r.company for r in records})
+        tax_bases = cls._get_discount_global_tax_bases(
+            [r for r in records if r.company in per_tax_companies])
+        excluded = cls._get_discount_global_excluded_amounts(
+            [r for r in records if r.company not in per_tax_companies])
+
+        result = {n: {} for n in names}
+        for record in records:
+            untaxed_amount = amounts['untaxed_amount'][record.id]
+            tax_amount = amounts['tax_amount'][record.id]
+            if record.id in tax_bases:
+                base = sum(tax_bases[record.id].values(), Decimal(0))
+            else:
+                base = untaxed_amount - excluded.get(record.id, Decimal(0))
+            party, company, _, _ = keys[record.id]
+            rate = rates[keys[record.id]]
+            if not rate:
+                rate = Bracket.get_bracket_discount(
+                    brackets.get((company, party), NO_BRACKETS),
+                    record._get_discount_global_bracket_amount(base)
+                    ) or Decimal(0)
+            if record.id in tax_bases:
+                discounts = {
+                    taxes: record.currency.round(round_price(b * rate))
+                    for taxes, b in tax_bases[record.id].items()}
+                discount = sum(discounts.values(), Decimal(0))
+                tax_discount = record._get_discount_global_tax_amount(
+                    discounts)
+            else:
+                discount = record.currency.round(round_price(base * rate))
+                # the taxes of the excluded lines are not discounted
+                tax_discount = record.currency.round(
+                    tax_amount * rate * base / untaxed_amount
+                    if untaxed_amount else Decimal(0))
+            if 'discount_global_amount' in result:
+                result['discount_global_amount'][record.id] = discount
+            if 'discount_global_total_amount' in result:
+                result['discount_global_total_amount'][record.id] = (
+                    untaxed_amount - discount + tax_amount - tax_discount)
+        return result
+
+    def _get_discount_global_bracket_amount(self, amount):
+        """
+        Return the amount converted to the currency of the company at the
+        currency date to be compared with the brackets
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Date = pool.get('ir.date')
+        if self.currency == self.company.currency:
+            return amount
+        date = self._get_discount_global_currency_date()
+        with Transaction().set_context(date=date or Date.today()):
+            return Currency.compute(
+                self.currency, amount, self.company.currency, round=False)
+
+    def _get_discount_global_currency_date(self):
+        "Return the date of the currency rate of the record"
+        raise NotImplementedError
+
+    @classmethod
+    def _get_discount_global_excluded_amounts(cls, records):
+        """
+        Return a dictionary with the amount of the lines of the excluded
+        products of each record
+
+        The amounts are aggregated with a query per slice of records grouped
+        by record, quantity and unit price and each group is rounded like the
+        amount of the lines.
+        """
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        Line = pool.get(cls.lines.model_name)
+        line = Line.__table__()
+        record_column = Column(line, cls.lines.field)
+        cursor = Transaction().connection.cursor()
+
+        excluded = Config.get_discount_global_excluded_products()
+        if not excluded:
+            return {}
+        currencies = {r.id: r.currency for r in records}
+        amounts = defaultdict(Decimal)
+        for sub_ids in grouped_slice(list(currencies)):
+            query = line.select(
+                record_column,
+                line.quantity.as_('quantity'),
+                line.unit_price.as_('unit_price'),
+                Count(Literal('*')),
+                where=reduce_ids(record_column, sub_ids)
+                & (line.type == 'line')
+                & reduce_ids(line.product, excluded),
+                group_by=[record_column, line.quantity, line.unit_price])
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, [None, None, 'NUMERIC', None])
+            cursor.execute(*query)
+            for record_id, quantity, unit_price, count in cursor:
+                amounts[record_id] += currencies[record_id].round(
+                    Decimal(str(quantity or 0))
+                    * (unit_price or Decimal(0))) * count
+        return amounts
+
+    @classmethod
+    def _get_discount_global_tax_bases(cls, records):
+        """
+        Return a dictionary with the untaxed amount of each record without
+        the lines of the excluded products grouped by the sorted tuple of tax
+        ids
+
+        The lines and their taxes are read with a query per slice of records
+        so lines are not instantiated.
+        """
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        Line = pool.get(cls.lines.model_name)
+        LineTax = pool.get(Line.taxes.relation_name)
+        line = Line.__table__()
+        line_tax = LineTax.__table__()
+        record_column = Column(line, cls.lines.field)
+        cursor = Transaction().connection.cursor()
+
+        currencies = {r.id: r.currency for r in records}
+        bases = {r: defaultdict(Decimal) for r in currencies}
+        where = line.type == 'line'
+        excluded = Config.get_discount_global_excluded_products()
+        if excluded:
+            where &= ((line.product == Null)
+                | ~reduce_ids(line.product, excluded))
+        for sub_ids in grouped_slice(list(currencies)):
+            query = line.join(line_tax, 'LEFT',
+                condition=Column(line_tax, Line.taxes.origin) == line.id
+                ).select(
+                    line.id, record_column,
+                    line.quantity.as_('quantity'),
+                    line.unit_price.as_('unit_price'),
+                    Column(line_tax, Line.taxes.target),
+                    where=where & reduce_ids(record_column, sub_ids))
+            if backend.name == 'sqlite':
+                sqlite_apply_types(
+                    query, [None, None, None, 'NUMERIC', None])
+            cursor.execute(*query)
+            lines = {}
+            for line_id, record_id, quantity, unit_price, tax in cursor:
+                if line_id not in lines:
+                    amount = currencies[record_id].round(
+                        Decimal(str(quantity or 0))
+                        * (unit_price or Decimal(0)))
+                    lines[line_id] = (record_id, amount, set())
+                if tax is not None:
+                    lines[line_id][2].add(tax)
+            for record_id, amount, taxes in lines.values():
+                bases[record_id][tuple(sorted(taxes))] += amount
+        return {r: dict(b) for r, b in bases.items()}
+
+    def _get_discount_global_tax_amount(self, discounts):
+        """
+        Return the tax amount of the discounts per sorted tuple of tax ids
+
+        The taxes are rounded per group of taxes like the global discount
+        lines of the invoice.
+        """
+        pool = Pool()
+        Tax = pool.get('account.tax')
+
+        amount = Decimal(0)
+        with Transaction().set_context(self._get_tax_context()):
+            for taxes, discount in discounts.items():
+                current = {}
+                for tax in Tax.compute(
+                        Tax.browse(taxes), discount, 1, self.tax_date):
+                    tax_line = self._compute_tax_line(**tax)
+                    if tax_line._key in current:
+                        current[tax_line._key] += tax_line
+                    else:
+                        current[tax_line._key] = tax_line
+                self._round_taxes(current)
+                amount += sum(
+                    (t.amount for t in current.values()), Decimal(0))
+        return amount
+
+
+class Sale(DiscountGlobalPreviewMixin, metaclass=PoolMeta):
     __name__ = 'sale.sale'
+    _discount_global_invoice_type = 'out'
+
+    def _get_discount_global_party(self):
+        return self.invoice_party or self.party
+
+    def _get_discount_global_currency_date(self):
+        return self.sale_date
 
     def _get_invoice(self):
         invoice = super(Sale, self)._get_invoice()
-        if invoice:
+        # In batch the discount is set by Invoice.create
+        if (invoice
+                and not Transaction().context.get('_invoice_discount_batch')):
             invoice.invoice_discount = (
                 invoice.on_change_with_invoice_discount())
         return invoice
 
+    @classmethod
+    def _process_invoice(cls, sales):
+        with Transaction().set_context(_invoice_discount_batch=True):
+            super(Sale, cls)._process_invoice(sales)
 
-class Purchase(metaclass=PoolMeta):
+
+class Purchase(DiscountGlobalPreviewMixin, metaclass=PoolMeta):
     __name__ = 'purchase.purchase'
+    _discount_global_invoice_type = 'in'
+
+    def _get_discount_global_party(self):
+        return self.invoice_party or self.party
+
+    def _get_discount_global_currency_date(self):
+        return self.purchase_date
 
     def _get_invoice(self):
         invoice = super(Purchase, self)._get_invoice()
-        if invoice:
+        # In batch the discount is set by Invoice.create
+        if (invoice
+                and not Transaction().context.get('_invoice_discount_batch')):
             invoice.invoice_discount = (
                 invoice.on_change_with_invoice_discount())
         return invoice
+
+    @classmethod
+    def _process_invoice(cls, purchases):
+        with Transaction().set_context(_invoice_discount_batch=True):
+            super(Purchase, cls)._process_invoice(purchases)
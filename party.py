@@ -1,13 +1,34 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import datetime
+import io
+from bisect import bisect_right
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+from itertools import chain, islice
+
+from sql import Null
+from trytond import backend
+from trytond.cache import Cache
 from trytond.config import config
-from trytond.model import fields
+from trytond.i18n import gettext
+from trytond.model import Index, ModelSQL, ModelView, fields
+from trytond.model.exceptions import ValidationError
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Eval
+from trytond.pyson import Eval, If
+from trytond.tools import grouped_slice, reduce_ids, sqlite_apply_types
+from trytond.transaction import Transaction
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+
+from . import instrumentation
 
-__all__ = ['Party', 'PartyAccount']
+__all__ = ['Party', 'PartyAccount', 'InvoiceDiscountBracket',
+    'InvoiceDiscountPeriod', 'ImportInvoiceDiscount',
+    'ImportInvoiceDiscountStart', 'ImportInvoiceDiscountDone']
 
 DISCOUNT_DIGITS = (16, config.getint('product', 'price_decimal', default=4))
+_MISSING = object()
 
 
 class Party(metaclass=PoolMeta):
@@ -22,7 +43,27 @@ class Party(metaclass=PoolMeta):
             states={
                 'invisible': ~Eval('context', {}).get('company'),
                 }))
-
+    invoice_discount_brackets = fields.One2Many(
+        'party.invoice_discount.bracket', 'party', "Invoice Discount Brackets",
+        domain=[
+            ('company', '=', Eval('context', {}).get('company', -1)),
+            ],
+        states={
+            'invisible': ~Eval('context', {}).get('company'),
+            },
+        help="The discount applied to the invoices without invoice discount "
+        "depending on their untaxed amount.")
+    invoice_discount_periods = fields.One2Many(
+        'party.invoice_discount.period', 'party', "Invoice Discount Periods",
+        domain=[
+            ('company', '=', Eval('context', {}).get('company', -1)),
+            ],
+        states={
+            'invisible': ~Eval('context', {}).get('company'),
+            },
+        help="The invoice discounts of the party which replace the customer "
+        "and supplier invoice discounts for the invoices dated in the "
+        "periods.")
 
     @classmethod
     def multivalue_model(cls, field):
@@ -31,6 +72,216 @@ class Party(metaclass=PoolMeta):
             return pool.get('party.party.account')
         return super(Party, cls).multivalue_model(field)
 
+    @classmethod
+    def get_invoice_discounts(cls, parties, company=None):
+        """
+        Return a dictionary with the customer and supplier invoice discounts
+        of each party for the company
+
+        The values are cached by company, party and invoice type. The missing
+        ones are read from party.party.account with one query per slice of
+        parties and follow the same priority as get_multivalue which sorts
+        the records of the company before those without company: the first
+        record by id of the company then the first record by id without
+        company.
+        """
+        pool = Pool()
+        PartyAccount = pool.get('party.party.account')
+        table = PartyAccount.__table__()
+        cursor = Transaction().connection.cursor()
+        cache = PartyAccount._invoice_discount_cache
+        names = ['customer_invoice_discount', 'supplier_invoice_discount']
+
+        if company is None:
+            company = Transaction().context.get('company')
+        company = int(company) if company is not None else None
+        if company is not None:
+            where_company = (
+                (table.company == company) | (table.company == Null))
+        else:
+            where_company = table.company == Null
+
+        discounts, missing = {}, {}
+        for party in map(int, parties):
+            customer = cache.get((company, party, 'out'), _MISSING)
+            supplier = cache.get((company, party, 'in'), _MISSING)
+            hit = customer is not _MISSING and supplier is not _MISSING
+            instrumentation.cache('party_invoice_discount', hit)
+            if hit:
+                discounts[party] = {
+                    'customer_invoice_discount': customer,
+                    'supplier_invoice_discount': supplier,
+                    }
+            else:
+                missing[party] = dict.fromkeys(names)
+        if not missing:
+            return discounts
+
+        companies = {}
+        for sub_ids in grouped_slice(list(missing)):
+            query = table.select(
+                table.party, table.company,
+                table.customer_invoice_discount.as_(
+                    'customer_invoice_discount'),
+                table.supplier_invoice_discount.as_(
+                    'supplier_invoice_discount'),
+                where=reduce_ids(table.party, sub_ids) & where_company,
+                order_by=[table.id.asc])
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, [None, None, 'NUMERIC', 'NUMERIC'])
+            cursor.execute(*query)
+            for party, company_id, customer, supplier in cursor:
+                if party in companies and (
+                        companies[party] is not None or company_id is None):
+                    continue
+                companies[party] = company_id
+                missing[party] = {
+                    'customer_invoice_discount': customer,
+                    'supplier_invoice_discount': supplier,
+                    }
+        for party, values in missing.items():
+            cache.set((company, party, 'out'),
+                values['customer_invoice_discount'])
+            cache.set((company, party, 'in'),
+                values['supplier_invoice_discount'])
+        discounts.update(missing)
+        return discounts
+
+    @classmethod
+    def import_invoice_discounts(cls, lines, chunk_size=1000):
+        """
+        Create or update the invoice discounts of the parties from CSV rows
+
+        Each row contains the party code, the company id (the context
+        company if empty), the customer and the supplier invoice discounts
+        (unchanged if empty). lines can be any iterable of strings like an
+        open file as the rows are read and saved by chunk of chunk_size.
+        Return the number of imported rows and the list of line number and
+        message of the rejected rows.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        default_company = Transaction().context.get('company')
+        companies = {}
+        imported, rejected = 0, []
+        reader = enumerate(csv.reader(lines), 1)
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                break
+
+            values = {}
+            for number, row in chunk:
+                if not any(row):
+                    continue
+                try:
+                    code, company, customer, supplier = (
+                        c.strip() for c in row)
+                except ValueError:
+                    rejected.append((number, gettext(
+                                'account_invoice_discount_global'
+                                '.msg_import_invoice_discount_columns')))
+                    continue
+                try:
+                    company = int(company) if company else default_company
+                    rates = cls._import_invoice_discount_rates(
+                        customer, supplier)
+                except (ValueError, InvalidOperation):
+                    rejected.append((number, gettext(
+                                'account_invoice_discount_global'
+                                '.msg_import_invoice_discount_value')))
+                    continue
+                if not all(0 <= r < 1 for r in rates.values()):
+                    rejected.append((number, gettext(
+                                'account_invoice_discount_global'
+                                '.msg_import_invoice_discount_range')))
+                    continue
+                values[number] = (code, company, rates)
+
+            missing = {c for _, c, _ in values.values()} - set(companies)
+            for company in Company.search([
+                        ('id', 'in', [c for c in missing if c]),
+                        ]):
+                companies[company.id] = True
+            companies.update(dict.fromkeys(missing - set(companies), False))
+            codes = list({c for c, _, _ in values.values()})
+            parties = {p.code: p.id for p in cls.search([
+                        ('code', 'in', codes),
+                        ], order=[])}
+
+            updates = {}
+            for number, (code, company, rates) in values.items():
+                if not companies[company]:
+                    rejected.append((number, gettext(
+                                'account_invoice_discount_global'
+                                '.msg_import_invoice_discount_company',
+                                company=company)))
+                elif code not in parties:
+                    rejected.append((number, gettext(
+                                'account_invoice_discount_global'
+                                '.msg_import_invoice_discount_party',
+                                code=code)))
+                else:
+                    key = (parties[code], company)
+                    updates[key] = {**updates.get(key, {}), **rates}
+                    imported += 1
+            cls._import_invoice_discount_chunk(updates)
+        return imported, sorted(rejected)
+
+    @classmethod
+    def _import_invoice_discount_rates(cls, customer, supplier):
+        rates = {}
+        for name, value in [
+                ('customer_invoice_discount', customer),
+                ('supplier_invoice_discount', supplier)]:
+            if value:
+                # the trailing zeros do not count as digits
+                rate = Decimal(value).normalize()
+                if (not rate.is_finite()
+                        or rate.as_tuple().exponent < -DISCOUNT_DIGITS[1]):
+                    raise ValueError(value)
+                rates[name] = rate
+        return rates
+
+    @classmethod
+    def _import_invoice_discount_chunk(cls, updates):
+        "Upsert the values of updates by party and company in bulk"
+        pool = Pool()
+        PartyAccount = pool.get('party.party.account')
+        updates = {k: v for k, v in updates.items() if v}
+        if not updates:
+            return
+
+        # update the first record of the party and company like
+        # get_multivalue
+        records = {}
+        for sub_keys in grouped_slice(list(updates)):
+            sub_keys = list(sub_keys)
+            for record in PartyAccount.search([
+                        ('party', 'in', list({p for p, _ in sub_keys})),
+                        ('company', 'in', list({c for _, c in sub_keys})),
+                        ], order=[('id', 'ASC')]):
+                records.setdefault(
+                    (record.party.id, record.company.id), record)
+
+        to_create, to_write = [], defaultdict(list)
+        for (party, company), values in updates.items():
+            record = records.get((party, company))
+            if record:
+                to_write[tuple(sorted(values.items()))].append(record)
+            else:
+                to_create.append({
+                        'party': party,
+                        'company': company,
+                        **values,
+                        })
+        if to_create:
+            PartyAccount.create(to_create)
+        if to_write:
+            PartyAccount.write(*chain(*(
+                        (r, dict(v)) for v, r in to_write.items())))
+
 
 class PartyAccount(metaclass=PoolMeta):
     __name__ = 'party.party.account'
@@ -39,3 +290,358 @@ class PartyAccount(metaclass=PoolMeta):
         "Customer Invoice Discount", digits=DISCOUNT_DIGITS)
     supplier_invoice_discount = fields.Numeric(
         "Supplier Invoice Discount", digits=DISCOUNT_DIGITS)
+    _invoice_discount_cache = Cache(
+        __name__ + '.invoice_discount', context=False)
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super(PartyAccount, cls).on_modification(
+            mode, records, field_names=field_names)
+        if (mode != 'write' or field_names is None
+                or field_names & {
+                    'party', 'company', 'customer_invoice_discount',
+                    'supplier_invoice_discount'}):
+            cls._invoice_discount_cache.clear()
+
+
+class InvoiceDiscountBracket(ModelSQL, ModelView):
+    "Party Invoice Discount Bracket"
+    __name__ = 'party.invoice_discount.bracket'
+    company = fields.Many2One(
+        'company.company', "Company", required=True, ondelete='CASCADE')
+    party = fields.Many2One(
+        'party.party', "Party", ondelete='CASCADE',
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'},
+        help="Leave empty for the default brackets of the company.")
+    type = fields.Selection([
+            ('out', "Customer"),
+            ('in', "Supplier"),
+            ], "Type", required=True)
+    amount = fields.Numeric(
+        "From Amount", digits=(16, 2), required=True,
+        domain=[('amount', '>=', 0)],
+        help="The minimal untaxed amount of the invoice in the currency "
+        "of the company.")
+    discount = fields.Numeric(
+        "Discount", digits=DISCOUNT_DIGITS, required=True)
+    _brackets_cache = Cache(__name__ + '.brackets', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(InvoiceDiscountBracket, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.company, Index.Range()),
+                (t.type, Index.Equality()),
+                (t.party, Index.Range())))
+        cls._order.insert(0, ('party', 'ASC NULLS FIRST'))
+        cls._order.insert(1, ('type', 'ASC'))
+        cls._order.insert(2, ('amount', 'ASC'))
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_type():
+        return 'out'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super(InvoiceDiscountBracket, cls).on_modification(
+            mode, records, field_names=field_names)
+        cls._brackets_cache.clear()
+
+    @classmethod
+    def get_brackets(cls, company, type_, parties):
+        """
+        Return a dictionary with the brackets of each party for the company
+        and the invoice type
+
+        The brackets are compiled into a tuple of the amounts sorted in
+        ascending order and a tuple of their discounts. The parties without
+        brackets get the default brackets of the company. The compiled
+        brackets are cached and the missing ones are read with one query per
+        slice of parties.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        company = int(company)
+
+        brackets, missing = {}, set()
+        for party in parties:
+            party = int(party)
+            value = cls._brackets_cache.get((company, type_, party))
+            if value is None:
+                missing.add(party)
+            else:
+                brackets[party] = value
+
+        if missing:
+            rows = defaultdict(list)
+            for sub_ids in grouped_slice(list(missing)):
+                query = table.select(
+                    table.party, table.amount.as_('amount'),
+                    table.discount.as_('discount'),
+                    where=((table.company == company)
+                        & (table.type == type_)
+                        & (reduce_ids(table.party, sub_ids)
+                            | (table.party == Null))),
+                    order_by=[table.amount.asc, table.id.asc])
+                if backend.name == 'sqlite':
+                    sqlite_apply_types(query, [None, 'NUMERIC', 'NUMERIC'])
+                cursor.execute(*query)
+                for party, amount, discount in cursor:
+                    rows[party].append((amount, discount))
+            default = cls._compile_brackets(rows.pop(None, []))
+            for party in missing:
+                if party in rows:
+                    value = cls._compile_brackets(rows[party])
+                else:
+                    value = default
+                cls._brackets_cache.set((company, type_, party), value)
+                brackets[party] = value
+        return brackets
+
+    @staticmethod
+    def _compile_brackets(rows):
+        # The last discount of the same amount wins
+        compiled = dict(rows)
+        amounts = tuple(sorted(compiled))
+        return amounts, tuple(compiled[a] for a in amounts)
+
+    @staticmethod
+    def get_bracket_discount(brackets, amount):
+        "Return the discount of the compiled brackets for the amount"
+        amounts, discounts = brackets
+        index = bisect_right(amounts, abs(amount)) - 1
+        if index >= 0:
+            return discounts[index]
+
+
+class InvoiceDiscountPeriod(ModelSQL, ModelView):
+    "Party Invoice Discount Period"
+    __name__ = 'party.invoice_discount.period'
+    company = fields.Many2One(
+        'company.company', "Company", required=True, ondelete='CASCADE')
+    party = fields.Many2One(
+        'party.party', "Party", required=True, ondelete='CASCADE',
+        context={
+            'company': Eval('company', -1),
+            },
+        depends={'company'})
+    type = fields.Selection([
+            ('out', "Customer"),
+            ('in', "Supplier"),
+            ], "Type", required=True)
+    start_date = fields.Date(
+        "Start Date",
+        domain=[
+            If(Eval('start_date') & Eval('end_date'),
+                ('start_date', '<=', Eval('end_date')),
+                ()),
+            ],
+        help="Leave empty for no start.")
+    end_date = fields.Date(
+        "End Date",
+        domain=[
+            If(Eval('start_date') & Eval('end_date'),
+                ('end_date', '>=', Eval('start_date')),
+                ()),
+            ],
+        help="Leave empty for no end.")
+    discount = fields.Numeric(
+        "Discount", digits=DISCOUNT_DIGITS, required=True)
+    _periods_cache = Cache(__name__ + '.periods', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(InvoiceDiscountPeriod, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.party, Index.Range()),
+                (t.company, Index.Equality()),
+                (t.type, Index.Equality()),
+                (t.start_date, Index.Range())))
+        cls._order.insert(0, ('party', 'ASC'))
+        cls._order.insert(1, ('type', 'ASC'))
+        cls._order.insert(2, ('start_date', 'ASC NULLS FIRST'))
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_type():
+        return 'out'
+
+    @classmethod
+    def validate(cls, periods):
+        super(InvoiceDiscountPeriod, cls).validate(periods)
+        for period in periods:
+            period.check_overlap()
+
+    def check_overlap(self):
+        domain = [
+            ('id', '!=', self.id),
+            ('company', '=', self.company.id),
+            ('party', '=', self.party.id),
+            ('type', '=', self.type),
+            ]
+        if self.start_date:
+            domain.append(['OR',
+                    ('end_date', '=', None),
+                    ('end_date', '>=', self.start_date),
+                    ])
+        if self.end_date:
+            domain.append(['OR',
+                    ('start_date', '=', None),
+                    ('start_date', '<=', self.end_date),
+                    ])
+        if self.search(domain, limit=1, order=[]):
+            raise ValidationError(gettext(
+                    'account_invoice_discount_global'
+                    '.msg_invoice_discount_period_overlap',
+                    party=self.party.rec_name))
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super(InvoiceDiscountPeriod, cls).on_modification(
+            mode, records, field_names=field_names)
+        cls._periods_cache.clear()
+
+    @classmethod
+    def get_periods(cls, company, type_, parties):
+        """
+        Return a dictionary with the periods of each party for the company
+        and the invoice type
+
+        The periods are compiled into a tuple of the start dates sorted in
+        ascending order, a tuple of their end dates and a tuple of their
+        discounts. The compiled periods are cached and the missing ones are
+        read with one query per slice of parties.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        company = int(company)
+
+        periods, missing = {}, set()
+        for party in parties:
+            party = int(party)
+            value = cls._periods_cache.get((company, type_, party))
+            if value is None:
+                missing.add(party)
+            else:
+                periods[party] = value
+
+        if missing:
+            rows = defaultdict(list)
+            for sub_ids in grouped_slice(list(missing)):
+                query = table.select(
+                    table.party, table.start_date.as_('start_date'),
+                    table.end_date.as_('end_date'),
+                    table.discount.as_('discount'),
+                    where=((table.company == company)
+                        & (table.type == type_)
+                        & reduce_ids(table.party, sub_ids)))
+                if backend.name == 'sqlite':
+                    sqlite_apply_types(
+                        query, [None, 'DATE', 'DATE', 'NUMERIC'])
+                cursor.execute(*query)
+                for party, start_date, end_date, discount in cursor:
+                    rows[party].append((start_date, end_date, discount))
+            for party in missing:
+                value = cls._compile_periods(rows.get(party, []))
+                cls._periods_cache.set((company, type_, party), value)
+                periods[party] = value
+        return periods
+
+    @staticmethod
+    def _compile_periods(rows):
+        rows = sorted(rows, key=lambda r: r[0] or datetime.date.min)
+        return (
+            tuple(r[0] or datetime.date.min for r in rows),
+            tuple(r[1] for r in rows),
+            tuple(r[2] for r in rows))
+
+    @staticmethod
+    def get_period_discount(periods, date):
+        "Return the discount of the compiled periods for the date"
+        start_dates, end_dates, discounts = periods
+        index = bisect_right(start_dates, date) - 1
+        if index >= 0 and (end_dates[index] is None
+                or date <= end_dates[index]):
+            return discounts[index]
+
+
+class ImportInvoiceDiscount(Wizard):
+    "Import Party Invoice Discounts"
+    __name__ = 'party.invoice_discount.import'
+    start = StateView('party.invoice_discount.import.start',
+        'account_invoice_discount_global.invoice_discount_import_start_view_form',
+        [
+            Button("Cancel", 'end', 'tryton-cancel'),
+            Button("Import", 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    done = StateView('party.invoice_discount.import.done',
+        'account_invoice_discount_global.invoice_discount_import_done_view_form',
+        [
+            Button("OK", 'end', 'tryton-ok', default=True),
+            ])
+
+    def transition_import_(self):
+        pool = Pool()
+        Party = pool.get('party.party')
+        lines = io.TextIOWrapper(
+            io.BytesIO(self.start.file), encoding='utf-8-sig', newline='')
+        offset = 0
+        if self.start.header:
+            next(lines, None)
+            offset = 1
+        with Transaction().set_context(company=self.start.company.id):
+            imported, rejected = Party.import_invoice_discounts(lines)
+        self.done.imported = imported
+        self.done.rejected = '\n'.join(
+            '%s: %s' % (number + offset, message)
+            for number, message in rejected)
+        return 'done'
+
+    def default_done(self, fields):
+        return {
+            'imported': self.done.imported,
+            'rejected': self.done.rejected,
+            }
+
+
+class ImportInvoiceDiscountStart(ModelView):
+    "Import Party Invoice Discounts"
+    __name__ = 'party.invoice_discount.import.start'
+    company = fields.Many2One(
+        'company.company', "Company", required=True,
+        help="The company of the rows without company.")
+    file = fields.Binary(
+        "File", required=True,
+        help="A CSV file with the party code, the company id, the customer "
+        "and the supplier invoice discounts.")
+    header = fields.Boolean("Header", help="Skip the first line of the file.")
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_header():
+        return True
+
+
+class ImportInvoiceDiscountDone(ModelView):
+    "Import Party Invoice Discounts"
+    __name__ = 'party.invoice_discount.import.done'
+    imported = fields.Integer("Imported Rows", readonly=True)
+    rejected = fields.Text("Rejected Rows", readonly=True)
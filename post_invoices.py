@@ -0,0 +1,179 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Post the draft and validated invoices with several processes
+
+The invoices are partitioned by company and party into chunks which are
+posted, with their global discount, by a pool of processes, each chunk in its
+own transaction. It is run by the trytond_post_invoices script:
+
+    trytond_post_invoices -c trytond.conf -d DATABASE -n 4 --chunk-size 200
+
+The configuration must be loaded before importing this module.
+"""
+import logging
+import sys
+import time
+from concurrent import futures
+from multiprocessing import cpu_count, get_context
+
+import trytond.config as config
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction, TransactionError
+from trytond.worker import run_task
+
+logger = logging.getLogger(__name__)
+
+
+def initializer(configfile, database_name):
+    config.update_etc(configfile)
+    database_list = Pool.database_list()
+    pool = Pool(database_name)
+    if database_name not in database_list:
+        with Transaction().start(database_name, 0, readonly=True):
+            pool.init()
+    return pool
+
+
+def get_chunks(database_name, companies, size):
+    """
+    Yield the company and the invoice ids of each chunk
+
+    The invoices of a party are kept in the same chunk so a chunk may have
+    more than size invoices.
+    """
+    with Transaction().start(database_name, 0, readonly=True) as transaction:
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        invoice = Invoice.__table__()
+        cursor = transaction.connection.cursor()
+
+        where = invoice.state.in_(['draft', 'validated'])
+        if companies:
+            where &= invoice.company.in_(companies)
+        cursor.execute(*invoice.select(
+                invoice.company, invoice.party, invoice.id,
+                where=where,
+                order_by=[invoice.company, invoice.party, invoice.id]))
+        company, party, ids = None, None, []
+        for invoice_company, invoice_party, invoice_id in cursor:
+            if ids and (invoice_company != company
+                    or (invoice_party != party and len(ids) >= size)):
+                yield company, ids
+                ids = []
+            company, party = invoice_company, invoice_party
+            ids.append(invoice_id)
+        if ids:
+            yield company, ids
+
+
+def get_user_context(database_name, login, company, skip_warnings=False):
+    "Return the id and the context of the user for the company"
+    with Transaction().start(database_name, 0, readonly=True):
+        pool = Pool()
+        User = pool.get('res.user')
+        user, = User.search([('login', '=', login)])
+        with Transaction().set_user(user.id):
+            context = User.get_preferences(context_only=True)
+    context['company'] = company
+    if skip_warnings:
+        context['_skip_warnings'] = True
+    return user.id, context
+
+
+def post_chunk(database_name, user, context, ids, retries, skip_locked=False):
+    """
+    Post the invoices and return the number of invoices posted
+
+    With skip_locked, the invoices locked by another transaction are not
+    posted.
+    """
+    pool = Pool(database_name)
+    Invoice = pool.get('account.invoice')
+    count = 0
+    extras = {}
+    while True:
+        if count:
+            time.sleep(0.02 * count)
+        with Transaction().start(
+                database_name, user, context=context,
+                **extras) as transaction:
+            try:
+                invoices = [i for i in Invoice.browse(ids)
+                    if i.state in {'draft', 'validated'}]
+                if skip_locked:
+                    invoices = Invoice.lock_skip_locked(invoices)
+                Invoice.post(invoices)
+            except TransactionError as e:
+                transaction.rollback()
+                transaction.tasks.clear()
+                e.fix(extras)
+                continue
+            except backend.DatabaseOperationalError:
+                if count < retries:
+                    transaction.rollback()
+                    transaction.tasks.clear()
+                    count += 1
+                    logger.debug("Retry: %i", count)
+                    continue
+                raise
+            transaction.commit()
+        while transaction.tasks:
+            run_task(pool, transaction.tasks.pop())
+        return len(invoices)
+
+
+def run(options):
+    "Post the invoices of the databases and return the number of failures"
+    try:
+        processes = options.processes or cpu_count()
+    except NotImplementedError:
+        processes = 1
+    retries = options.retries
+    if retries is None:
+        retries = config.getint('database', 'retry')
+
+    failures = 0
+    for database_name in options.database_names:
+        start = time.perf_counter()
+        initializer(options.configfile, database_name)
+        chunks = list(get_chunks(
+                database_name, options.companies, options.chunk_size))
+        contexts = {}
+        for company in {c for c, _ in chunks}:
+            contexts[company] = get_user_context(
+                database_name, options.user, company,
+                skip_warnings=options.skip_warnings)
+
+        # the processes are spawned to not share the database connections
+        tasks = []
+        with futures.ProcessPoolExecutor(
+                max_workers=processes, mp_context=get_context('spawn'),
+                initializer=initializer,
+                initargs=(options.configfile, database_name)) as executor:
+            for company, ids in chunks:
+                user, context = contexts[company]
+                future = executor.submit(
+                    post_chunk, database_name, user, context, ids, retries,
+                    skip_locked=options.skip_locked)
+                tasks.append((future, company, ids))
+
+            posted, failed = 0, []
+            for future, company, ids in tasks:
+                try:
+                    posted += future.result()
+                except Exception as exception:
+                    failed.append((company, ids, exception))
+
+        print("%s: %d chunks, %d of %d invoices posted, %d chunks failed "
+            "in %.1f s" % (
+                database_name, len(tasks), posted,
+                sum(len(ids) for _, ids in chunks), len(failed),
+                time.perf_counter() - start))
+        for company, ids, exception in failed:
+            print("  company %s, invoices %s: %s" % (
+                    company, ', '.join(map(str, ids)), exception),
+                file=sys.stderr)
+        failures += len(failed)
+    return failures
@@ -0,0 +1,92 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta, Pool
+
+__all__ = ['Template', 'Product', 'Category', 'CategoryAccount']
+
+
+class DiscountProductCacheMixin(object):
+    """
+    Clear the cached discount product values when the records they are read
+    from change and the global discount excluded products when the
+    categories of the products change
+    """
+    __slots__ = ()
+    # the fields which change the products of the excluded categories
+    _discount_global_excluded_fields = set()
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        super(DiscountProductCacheMixin, cls).on_modification(
+            mode, records, field_names=field_names)
+        if cls._is_discount_global_excluded_modified(mode, field_names):
+            Config._discount_global_excluded_cache.clear()
+        if cls._is_discount_product_modified(records):
+            # the modified records may also change the related ids
+            Config._discount_product_cache.clear()
+            Config._discount_product_ids_cache.clear()
+
+    @classmethod
+    def _is_discount_global_excluded_modified(cls, mode, field_names):
+        "Return if the modification changes the excluded products"
+        return (mode in {'create', 'delete'}
+            or bool((field_names or set())
+                & cls._discount_global_excluded_fields))
+
+    @classmethod
+    def _is_discount_product_modified(cls, records):
+        "Return if the records modify the values of a discount product"
+        return False
+
+    @classmethod
+    def _get_discount_product_ids(cls, model_name):
+        "Return the cached ids of the discount product records of the model"
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        return Config.get_discount_product_ids()[model_name]
+
+
+class Template(DiscountProductCacheMixin, metaclass=PoolMeta):
+    __name__ = 'product.template'
+    _discount_global_excluded_fields = {'categories', 'account_category'}
+
+    @classmethod
+    def _is_discount_product_modified(cls, records):
+        template_ids = cls._get_discount_product_ids(cls.__name__)
+        return any(r.id in template_ids for r in records)
+
+
+class Product(DiscountProductCacheMixin, metaclass=PoolMeta):
+    __name__ = 'product.product'
+    _discount_global_excluded_fields = {'template'}
+
+    @classmethod
+    def _is_discount_product_modified(cls, records):
+        product_ids = cls._get_discount_product_ids(cls.__name__)
+        return any(r.id in product_ids for r in records)
+
+
+class Category(DiscountProductCacheMixin, metaclass=PoolMeta):
+    __name__ = 'product.category'
+    _discount_global_excluded_fields = {'parent'}
+
+    @classmethod
+    def _is_discount_product_modified(cls, records):
+        category_ids = cls._get_discount_product_ids(cls.__name__)
+        return any(r.id in category_ids for r in records)
+
+
+class CategoryAccount(DiscountProductCacheMixin, metaclass=PoolMeta):
+    __name__ = 'product.category.account'
+
+    @classmethod
+    def _is_discount_global_excluded_modified(cls, mode, field_names):
+        return False
+
+    @classmethod
+    def _is_discount_product_modified(cls, records):
+        category_ids = cls._get_discount_product_ids('product.category')
+        return any(r.category and r.category.id in category_ids
+            for r in records)
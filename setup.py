@@ -110,6 +110,7 @@ setup(name='%s_%s' % (PREFIX, MODULE),
     install_requires=requires,
     dependency_links=dependency_links,
     zip_safe=False,
+    scripts=['bin/trytond_post_invoices'],
     entry_points="""
     [trytond.modules]
     %s = trytond.modules.%s
@@ -0,0 +1,297 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Benchmark of the global discount operations
+
+It generates N parties and N invoices with M lines each and reports for each
+operation the wall time, the number of SQL statements and the peak of memory
+allocated by Python.
+
+The database is configured like for the tests, for example on SQLite:
+
+    DB_NAME=:memory: python -m \\
+        trytond.modules.account_invoice_discount_global.tests.benchmark
+
+or on a local PostgreSQL:
+
+    TRYTOND_DATABASE_URI=postgresql:/// DB_NAME=benchmark python -m \\
+        trytond.modules.account_invoice_discount_global.tests.benchmark \\
+        --sizes 100 1000 10000 --lines 5
+"""
+import argparse
+import datetime
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.company.tests import create_company, set_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, activate_module
+from trytond.transaction import Transaction, TransactionError
+
+MODULE = 'account_invoice_discount_global'
+
+
+class QueryCounter(logging.Handler):
+    "Count the SQL statements logged by the database backends"
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        message = record.getMessage()
+        if record.name.endswith('sqlite.database') or message.startswith(
+                'query:'):
+            self.count += 1
+
+
+@contextmanager
+def measure(results, size, name, counter):
+    start_count = counter.count
+    tracemalloc.reset_peak()
+    start_memory, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    results.append(
+        (size, name, elapsed, counter.count - start_count,
+            (peak - start_memory) / 1024 / 1024))
+
+
+def in_transaction(func, *args, context=None, commit=False):
+    "Run func in a new transaction retrying with the locks it requests"
+    extras = {}
+    while True:
+        with Transaction().start(
+                DB_NAME, 0, context=context, **extras) as transaction:
+            try:
+                result = func(*args)
+            except TransactionError as e:
+                transaction.rollback()
+                e.fix(extras)
+                continue
+            finally:
+                transaction.tasks.clear()
+            if commit:
+                transaction.commit()
+            else:
+                transaction.rollback()
+            return result
+
+
+def setup(modules):
+    "Create the company, accounting and products and return the context"
+    pool = Pool()
+    Account = pool.get('account.account')
+    Category = pool.get('product.category')
+    Config = pool.get('account.configuration')
+    PaymentTerm = pool.get('account.invoice.payment_term')
+    Tax = pool.get('account.tax')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    company = create_company()
+    with set_company(company):
+        create_chart(company, tax=True)
+        fiscalyear = set_invoice_sequences(get_fiscalyear(company))
+        fiscalyear.save()
+        fiscalyear.create_period([fiscalyear])
+
+        revenue, = Account.search([
+                ('type.revenue', '=', True),
+                ('closed', '!=', True),
+                ], limit=1)
+        expense, = Account.search([
+                ('type.expense', '=', True),
+                ('closed', '!=', True),
+                ], limit=1)
+        tax, = Tax.search([], limit=1)
+        category = Category(name="Account Category", accounting=True)
+        category.account_revenue = revenue
+        category.account_expense = expense
+        category.customer_taxes = [tax]
+        category.supplier_taxes = [tax]
+        category.save()
+
+        unit, = Uom.search([('name', '=', "Unit")])
+        template_values = {
+            'type': 'service',
+            'default_uom': unit.id,
+            'account_category': category.id,
+            'products': [('create', [{}])],
+            }
+        if 'sale' in modules:
+            template_values.update(salable=True, sale_uom=unit.id)
+        if 'purchase' in modules:
+            template_values.update(purchasable=True, purchase_uom=unit.id)
+        product_template, discount_template = Template.create([{
+                    'name': name,
+                    'list_price': Decimal(price),
+                    **template_values,
+                    } for name, price in [
+                    ("Product", '40'), ("Discount", '0')]])
+
+        config = Config(1)
+        config.discount_product = discount_template.products[0]
+        config.save()
+
+        payment_term = PaymentTerm(name="Direct")
+        payment_term.lines = [{'type': 'remainder'}]
+        payment_term.save()
+        context = Transaction().context.copy()
+    return {
+        'company': company.id,
+        'product': product_template.products[0].id,
+        'unit': unit.id,
+        'payment_term': payment_term.id,
+        'context': context,
+        }
+
+
+def create_invoices(data, size, lines, type_='out'):
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    Journal = pool.get('account.journal')
+    Party = pool.get('party.party')
+
+    parties = Party.create([{
+                'name': "Party %s" % i,
+                'addresses': [('create', [{}])],
+                'customer_invoice_discount': Decimal('0.05'),
+                'supplier_invoice_discount': Decimal('0.03'),
+                } for i in range(size)])
+    journal, = Journal.search([
+            ('type', '=', 'revenue' if type_ == 'out' else 'expense'),
+            ], limit=1)
+    today = datetime.date.today()
+    invoices = Invoice.create([{
+                'type': type_,
+                'company': data['company'],
+                'party': party.id,
+                'invoice_address': party.addresses[0].id,
+                'currency': party_currency(data),
+                'journal': journal.id,
+                'account': (party.account_receivable_used.id if type_ == 'out'
+                    else party.account_payable_used.id),
+                'payment_term': data['payment_term'],
+                'invoice_date': today,
+                'invoice_discount': (
+                    party.customer_invoice_discount if type_ == 'out'
+                    else party.supplier_invoice_discount),
+                'lines': [('create', [{
+                                'product': data['product'],
+                                'unit': data['unit'],
+                                'account': invoice_line_account(data, type_),
+                                'quantity': i + 1,
+                                'unit_price': Decimal('12.3456'),
+                                } for i in range(lines)])],
+                } for party in parties])
+    return parties, invoices
+
+
+def party_currency(data):
+    pool = Pool()
+    Company = pool.get('company.company')
+    return Company(data['company']).currency.id
+
+
+def invoice_line_account(data, type_):
+    pool = Pool()
+    Product = pool.get('product.product')
+    product = Product(data['product'])
+    if type_ == 'out':
+        return product.account_revenue_used.id
+    return product.account_expense_used.id
+
+
+def run(data, size, lines, modules, counter):
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    results = []
+
+    def browse(invoices):
+        return Invoice.browse([i.id for i in invoices])
+
+    parties, invoices = create_invoices(data, size, lines)
+    with measure(results, size, 'validate_invoice', counter):
+        Invoice.validate_invoice(browse(invoices))
+    with measure(results, size, 'draft', counter):
+        Invoice.draft(browse(invoices))
+    Invoice.compute_discount_global(browse(invoices))
+    with measure(results, size, 'remove_discount_global', counter):
+        Invoice.remove_discount_global(browse(invoices))
+    with measure(results, size, 'post', counter):
+        Invoice.post(browse(invoices))
+
+    _, invoices = create_invoices(data, size, lines, type_='in')
+    Invoice.validate_invoice(browse(invoices))
+    with measure(results, size, 'cancel', counter):
+        Invoice.cancel(browse(invoices))
+
+    for model, name in [
+            ('sale.sale', 'Sale._get_invoice'),
+            ('purchase.purchase', 'Purchase._get_invoice')]:
+        if model.split('.')[0] not in modules:
+            continue
+        Model = pool.get(model)
+        records = [Model(
+                company=data['company'],
+                party=party,
+                invoice_party=party,
+                invoice_address=party.addresses[0],
+                currency=party_currency(data),
+                payment_term=data['payment_term'])
+            for party in parties]
+        with measure(results, size, name, counter):
+            for record in records:
+                record._get_invoice()
+    return results
+
+
+def main(sizes, lines, modules):
+    counter = QueryCounter()
+    logger = logging.getLogger('trytond.backend')
+    logger.addHandler(counter)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    activate_module([MODULE] + modules)
+    data = in_transaction(setup, modules, commit=True)
+
+    tracemalloc.start()
+    results = []
+    for size in sizes:
+        results.extend(in_transaction(
+                run, data, size, lines, modules, counter,
+                context=data['context']))
+    tracemalloc.stop()
+
+    print('%8s %-24s %10s %10s %12s' % (
+            'invoices', 'operation', 'seconds', 'queries', 'peak MiB'))
+    for size, name, elapsed, queries, peak in results:
+        print('%8d %-24s %10.3f %10d %12.1f' % (
+                size, name, elapsed, queries, peak))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the global discount operations")
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[100, 1000, 10000], help="the numbers of invoices")
+    parser.add_argument('--lines', type=int, default=5,
+        help="the number of lines per invoice")
+    parser.add_argument('--modules', nargs='*', default=['sale', 'purchase'],
+        choices=['sale', 'purchase'],
+        help="the optional modules to activate and benchmark")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    main(arguments.sizes, arguments.lines, arguments.modules)
@@ -2,13 +2,718 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime as dt
+import io
+from decimal import Decimal
+from unittest.mock import patch
+
+from trytond import backend
+from trytond.model.exceptions import (
+    AccessButtonError, SQLConstraintError, ValidationError)
+from trytond.modules.account_invoice_discount_global import instrumentation
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction, check_access
+
+from .benchmark import create_invoices, setup
 
 
 class AccountInvoiceDiscountGlobalTestCase(CompanyTestMixin, ModuleTestCase):
     'Test AccountInvoiceDiscountGlobal module'
     module = 'account_invoice_discount_global'
+    extras = ['sale', 'purchase']
+
+    @with_transaction()
+    def test_instrumentation(self):
+        "Test instrumentation"
+        cursor = Transaction().connection.cursor()
+        execute = type(cursor).execute
+
+        @instrumentation.instrumented('test')
+        def func(hit):
+            instrumentation.add('invoices', 2)
+            instrumentation.cache('test', hit)
+            cursor.execute('SELECT 1')
+
+        enabled = instrumentation.is_enabled()
+        instrumentation.reset_stats()
+        instrumentation.disable()
+        try:
+            func(True)
+            self.assertEqual(
+                instrumentation.get_stats(), {'calls': {}, 'caches': {}})
+
+            instrumentation.enable()
+            func(False)
+            func(True)
+            func(True)
+            stats = instrumentation.get_stats()
+        finally:
+            if not enabled:
+                instrumentation.disable()
+            instrumentation.reset_stats()
+
+        self.assertEqual(stats['calls']['test']['calls'], 3)
+        self.assertEqual(stats['calls']['test']['invoices'], 6)
+        self.assertEqual(stats['calls']['test']['queries'], 3)
+        self.assertIs(type(cursor).execute, execute)
+        self.assertEqual(stats['caches']['test'], {
+                'hits': 2,
+                'misses': 1,
+                'hit_rate': 2 / 3,
+                })
+
+    @with_transaction()
+    def test_import_invoice_discounts(self):
+        "Test import invoice discounts"
+        pool = Pool()
+        Party = pool.get('party.party')
+
+        company = create_company()
+        with set_company(company):
+            party1, party2 = Party.create([
+                    {'name': "Party 1", 'code': 'P1'},
+                    {'name': "Party 2", 'code': 'P2'},
+                    ])
+            party2.customer_invoice_discount = Decimal('0.01')
+            party2.supplier_invoice_discount = Decimal('0.02')
+            party2.save()
+
+            imported, rejected = Party.import_invoice_discounts(io.StringIO(
+                    "P1,,0.05,0.03\n"
+                    "P2,%s,0.1,\n"
+                    "P3,,0.1,0.1\n"
+                    "P1,,abc,\n"
+                    "P1,999,0.1,0.1\n"
+                    "P1,0.1\n"
+                    "P2,,,0.10000\n"
+                    "P2,,1,\n"
+                    "P2,,,-0.1\n" % company.id), chunk_size=2)
+
+            self.assertEqual(imported, 3)
+            self.assertEqual([n for n, _ in rejected], [3, 4, 5, 6, 8, 9])
+            messages = dict(rejected)
+            self.assertEqual(messages[8], messages[9])
+            self.assertNotEqual(messages[4], messages[8])
+            party1, party2 = Party.browse([party1, party2])
+            self.assertEqual(
+                party1.customer_invoice_discount, Decimal('0.05'))
+            self.assertEqual(
+                party1.supplier_invoice_discount, Decimal('0.03'))
+            self.assertEqual(
+                party2.customer_invoice_discount, Decimal('0.1'))
+            self.assertEqual(
+                party2.supplier_invoice_discount, Decimal('0.1'))
+
+    @with_transaction()
+    def test_invoice_discounts_cache(self):
+        "Test invoice discounts cache"
+        pool = Pool()
+        Party = pool.get('party.party')
+        PartyAccount = pool.get('party.party.account')
+        cache = PartyAccount._invoice_discount_cache
+
+        company = create_company()
+        with set_company(company):
+            party = Party(name="Party")
+            party.customer_invoice_discount = Decimal('0.05')
+            party.save()
+
+            discounts = Party.get_invoice_discounts([party])
+            self.assertEqual(discounts, {party.id: {
+                        'customer_invoice_discount': Decimal('0.05'),
+                        'supplier_invoice_discount': None,
+                        }})
+            self.assertEqual(
+                cache.get((company.id, party.id, 'out')), Decimal('0.05'))
+
+            party.supplier_invoice_discount = Decimal('0.02')
+            party.save()
+            self.assertEqual(
+                Party.get_invoice_discounts([party])[party.id], {
+                    'customer_invoice_discount': Decimal('0.05'),
+                    'supplier_invoice_discount': Decimal('0.02'),
+                    })
+
+    @with_transaction()
+    def test_invoice_discounts_batch(self):
+        "Test invoice discounts set in batch like get_multivalue"
+        pool = Pool()
+        Company = pool.get('company.company')
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+        PartyAccount = pool.get('party.party.account')
+        Sale = pool.get('sale.sale')
+        transaction = Transaction()
+
+        data = setup(self.extras)
+        company = Company(data['company'])
+        with transaction.set_context(data['context']):
+            party = Party(name="Party", addresses=[{}])
+            party.save()
+            PartyAccount.delete(PartyAccount.search([
+                        ('party', '=', party.id),
+                        ]))
+            PartyAccount.create([{
+                        'party': party.id,
+                        'company': None,
+                        'customer_invoice_discount': Decimal('0.05'),
+                        }, {
+                        'party': party.id,
+                        'company': company.id,
+                        'customer_invoice_discount': Decimal('0.1'),
+                        }])
+            party = Party(party.id)
+            self.assertEqual(
+                party.customer_invoice_discount, Decimal('0.1'))
+            self.assertEqual(
+                Party.get_invoice_discounts([party])[party.id][
+                    'customer_invoice_discount'],
+                party.customer_invoice_discount)
+
+            sale = Sale(
+                company=company,
+                party=party,
+                invoice_party=party,
+                invoice_address=party.addresses[0],
+                currency=company.currency,
+                payment_term=data['payment_term'])
+            invoice = sale._get_invoice()
+            self.assertEqual(
+                invoice.invoice_discount, party.customer_invoice_discount)
+
+            with transaction.set_context(_invoice_discount_batch=True):
+                invoice = sale._get_invoice()
+                invoice.save()
+            self.assertEqual(
+                Invoice(invoice.id).invoice_discount,
+                party.customer_invoice_discount)
+
+    @with_transaction()
+    def test_update_invoice_discounts_credit_note(self):
+        "Test update of invoice discounts skips draft credit notes"
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+        transaction = Transaction()
+
+        data = setup(self.extras)
+        with transaction.set_context(data['context'], _skip_warnings=True):
+            parties, [invoice] = create_invoices(data, 1, 1)
+            Invoice.post([invoice])
+            credit, = Invoice.credit([invoice])
+            self.assertTrue(credit.discount_global_computed)
+            amount = credit.discount_global_amount
+
+            Party.write(parties, {
+                    'customer_invoice_discount': Decimal('0.5'),
+                    })
+            self.assertEqual(Invoice.update_draft_invoice_discounts(), 0)
+            Invoice.update_invoice_discounts([credit])
+
+            credit = Invoice(credit.id)
+            self.assertEqual(credit.invoice_discount, Decimal('0.05'))
+            self.assertEqual(credit.discount_global_amount, amount)
+            self.assertTrue(credit.discount_global_computed)
+
+            config = Config(1)
+            config.discount_global_update = True
+            config.save()
+            credit.invoice_discount = Decimal('0.1')
+            credit.save()
+            self.assertFalse(credit.discount_global_computed)
+            Invoice.compute_discount_global([credit])
+            credit = Invoice(credit.id)
+            self.assertEqual(credit.discount_global_amount, 2 * amount)
+
+    @with_transaction()
+    def test_invoice_discount_periods(self):
+        "Test invoice discount periods"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+        Period = pool.get('party.invoice_discount.period')
+
+        company = create_company()
+        with set_company(company):
+            party = Party(name="Party")
+            party.customer_invoice_discount = Decimal('0.05')
+            party.save()
+            Period.create([{
+                        'party': party.id,
+                        'type': 'out',
+                        'start_date': dt.date(2024, 1, 1),
+                        'end_date': dt.date(2024, 6, 30),
+                        'discount': Decimal('0.02'),
+                        }, {
+                        'party': party.id,
+                        'type': 'out',
+                        'start_date': dt.date(2024, 7, 1),
+                        'discount': Decimal('0.03'),
+                        }])
+
+            keys = {
+                dt.date(2023, 12, 31): Decimal('0.05'),
+                dt.date(2024, 1, 1): Decimal('0.02'),
+                dt.date(2024, 6, 30): Decimal('0.02'),
+                dt.date(2024, 7, 1): Decimal('0.03'),
+                None: Decimal('0.03'),
+                }
+            discounts = Invoice.get_party_invoice_discounts(
+                {(party.id, company.id, 'out', d) for d in keys})
+            for date, discount in keys.items():
+                with self.subTest(date=date):
+                    self.assertEqual(
+                        discounts[party.id, company.id, 'out', date],
+                        discount)
+            key = (party.id, company.id, 'in', dt.date(2024, 3, 1))
+            self.assertIsNone(Invoice.get_party_invoice_discounts({key})[key])
+
+            with self.assertRaises(ValidationError):
+                Period.create([{
+                            'party': party.id,
+                            'type': 'out',
+                            'start_date': dt.date(2024, 6, 1),
+                            'end_date': dt.date(2024, 7, 15),
+                            'discount': Decimal('0.04'),
+                            }])
+
+    @with_transaction()
+    def test_discount_global_bases_pages(self):
+        "Test discount global bases of invoices larger than a page"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        transaction = Transaction()
+
+        data = setup(self.extras)
+        with transaction.set_context(data['context']):
+            _, invoices = create_invoices(data, 3, 2)
+            _, [invoice] = create_invoices(
+                data, 1, transaction.database.IN_MAX + 5)
+            invoices.append(invoice)
+
+            bases = Invoice._get_discount_global_bases(invoices)
+            tax_bases = Invoice._get_discount_global_tax_bases(invoices)
+
+            for invoice in invoices:
+                self.assertEqual(bases[invoice.id], invoice.untaxed_amount)
+                self.assertEqual(
+                    sum(tax_bases[invoice.id].values()),
+                    invoice.untaxed_amount)
+
+    @with_transaction()
+    def test_discount_global_taxes_lines_read(self):
+        "Test global discount taxes updated without the other lines"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+
+        taxable_lines = Line.taxable_lines
+        taxed = set()
+
+        def get_taxable_lines(line):
+            taxed.add(line.id)
+            return taxable_lines.fget(line)
+
+        data = setup(self.extras)
+        with Transaction().set_context(data['context']):
+            _, [invoice] = create_invoices(data, 1, 200)
+            tax_amount = invoice.tax_amount
+
+            with patch.object(
+                    Line, 'taxable_lines', property(get_taxable_lines)):
+                Invoice.compute_discount_global([invoice])
+            self.assertLessEqual(len(taxed), 1)
+            invoice = Invoice(invoice.id)
+            self.assertLess(invoice.tax_amount, tax_amount)
+            Invoice.update_taxes([invoice], exception=True)
+
+            taxed.clear()
+            with patch.object(
+                    Line, 'taxable_lines', property(get_taxable_lines)):
+                Invoice.remove_discount_global([invoice])
+            self.assertLessEqual(len(taxed), 1)
+            invoice = Invoice(invoice.id)
+            self.assertEqual(invoice.tax_amount, tax_amount)
+            Invoice.update_taxes([invoice], exception=True)
+
+    @with_transaction()
+    def test_discount_global_excluded_categories(self):
+        "Test discount global bases without the excluded categories"
+        pool = Pool()
+        Category = pool.get('product.category')
+        Config = pool.get('account.configuration')
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+
+        data = setup(self.extras)
+        with Transaction().set_context(data['context']):
+            _, [invoice] = create_invoices(data, 1, 3)
+            services = Category(name="Services")
+            services.save()
+            shipping = Category(name="Shipping", parent=services)
+            shipping.save()
+            template, = Template.copy(
+                [Product(data['product']).template],
+                default={'categories': [shipping.id]})
+            product, = template.products
+            line = invoice.lines[0]
+            Line.write([line], {'product': product.id})
+
+            config = Config(1)
+            config.discount_global_excluded_categories = [services]
+            config.save()
+            self.assertEqual(
+                Config.get_discount_global_excluded_products(),
+                {product.id})
+
+            bases = Invoice._get_discount_global_bases([invoice])
+            tax_bases = Invoice._get_discount_global_tax_bases([invoice])
+            self.assertEqual(
+                bases[invoice.id], invoice.untaxed_amount - line.amount)
+            self.assertEqual(
+                sum(tax_bases[invoice.id].values()), bases[invoice.id])
+
+            template.categories = []
+            template.save()
+            self.assertEqual(
+                Config.get_discount_global_excluded_products(), set())
+            bases = Invoice._get_discount_global_bases([invoice])
+            self.assertEqual(bases[invoice.id], invoice.untaxed_amount)
+
+    @with_transaction()
+    def test_discount_global_preview(self):
+        "Test sale preview without the excluded products and per tax"
+        pool = Pool()
+        Category = pool.get('product.category')
+        Config = pool.get('account.configuration')
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+        Sale = pool.get('sale.sale')
+        Tax = pool.get('account.tax')
+        Template = pool.get('product.template')
+
+        data = setup(self.extras)
+        with Transaction().set_context(data['context']):
+            party = Party(name="Party", addresses=[{}])
+            party.customer_invoice_discount = Decimal('0.1')
+            party.save()
+            product = Product(data['product'])
+            tax, = product.customer_taxes_used
+            services = Category(name="Services")
+            services.save()
+            template, = Template.copy(
+                [product.template], default={'categories': [services.id]})
+            excluded, = template.products
+            config = Config(1)
+            config.discount_global_excluded_categories = [services]
+            config.save()
+
+            sale = Sale(
+                company=data['company'],
+                party=party,
+                invoice_party=party,
+                invoice_address=party.addresses[0],
+                payment_term=data['payment_term'])
+            sale.lines = [{
+                    'product': p.id,
+                    'quantity': 1,
+                    'unit': data['unit'],
+                    'unit_price': price,
+                    'taxes': [tax.id],
+                    } for p, price in [
+                    (product, Decimal('100.1')),
+                    (excluded, Decimal('50'))]]
+            sale.save()
+            tax_discount = sum(t['amount'] for t in Tax.compute(
+                    [tax], Decimal('10.01'), 1, sale.tax_date))
+
+            self.assertEqual(sale.discount_global_amount, Decimal('10.01'))
+            self.assertEqual(
+                sale.discount_global_total_amount,
+                sale.total_amount - Decimal('10.01')
+                - sale.currency.round(tax_discount))
+
+            config.discount_global_per_tax = True
+            config.save()
+            sale = Sale(sale.id)
+            self.assertEqual(sale.discount_global_amount, Decimal('10.01'))
+            self.assertEqual(
+                sale.discount_global_total_amount,
+                sale.total_amount - Decimal('10.01')
+                - sale.currency.round(tax_discount))
+
+    @with_transaction()
+    def test_discount_global_bracket_currency(self):
+        "Test brackets compared with the amount in company currency"
+        pool = Pool()
+        Bracket = pool.get('party.invoice_discount.bracket')
+        Currency = pool.get('currency.currency')
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+        Sale = pool.get('sale.sale')
+
+        data = setup(self.extras)
+        with Transaction().set_context(data['context']):
+            currency = Currency(name="Foreign", code="FRG", symbol="F")
+            currency.rates = [{
+                    'date': dt.date(2000, 1, 1),
+                    'rate': Decimal(2),
+                    }]
+            currency.save()
+            party = Party(name="Party", addresses=[{}])
+            party.save()
+            Bracket.create([{
+                        'company': data['company'],
+                        'type': 'out',
+                        'amount': Decimal(100),
+                        'discount': Decimal('0.1'),
+                        }])
+            invoice = Invoice(
+                type='out',
+                company=data['company'],
+                currency=currency,
+                party=party,
+                invoice_date=dt.date.today(),
+                invoice_discount=None)
+
+            self.assertEqual(
+                invoice._get_discount_global_rate(Decimal(150)), Decimal(0))
+            self.assertEqual(
+                invoice._get_discount_global_rate(Decimal(200)),
+                Decimal('0.1'))
+
+            sale = Sale(
+                company=data['company'],
+                currency=currency,
+                party=party,
+                invoice_party=party,
+                invoice_address=party.addresses[0],
+                payment_term=data['payment_term'])
+            sale.lines = [{
+                    'product': data['product'],
+                    'quantity': 1,
+                    'unit': data['unit'],
+                    'unit_price': Decimal(150),
+                    }]
+            sale.save()
+            self.assertEqual(sale.discount_global_amount, Decimal(0))
+            sale.lines[0].unit_price = Decimal(200)
+            sale.lines[0].save()
+            sale = Sale(sale.id)
+            self.assertEqual(sale.discount_global_amount, Decimal(20))
+
+    @with_transaction()
+    def test_discount_global_unique(self):
+        "Test one global discount line per invoice and taxes"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+
+        data = setup(self.extras)
+        with Transaction().set_context(data['context']):
+            _, [invoice] = create_invoices(data, 1, 1)
+            Invoice.compute_discount_global([invoice])
+            line, = Invoice._get_discount_global_lines([invoice])
+
+            with self.assertRaises(SQLConstraintError):
+                Line.copy([line])
+
+            Line.copy([line], default={'discount_global_taxes': ''})
+
+    @with_transaction()
+    def test_discount_product_company(self):
+        "Test discount product per company"
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        Company = pool.get('company.company')
+
+        data = setup(self.extras)
+        company = Company(data['company'])
+        other_company = create_company(name="Other Company")
+        with Transaction().set_context(data['context']):
+            values = Config.get_discount_product_values(company, 'out')
+            self.assertEqual(values['product'], Config(1).discount_product.id)
+            self.assertEqual(
+                Config.get_discount_product_values(other_company, 'out'), {})
+
+    @with_transaction()
+    def test_discount_product_migration(self):
+        "Test migration of the discount product to the companies"
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        ConfigDiscountProduct = pool.get(
+            'account.configuration.discount_product')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        data = setup(self.extras)
+        with transaction.set_context(data['context']):
+            product = Config(1).discount_product
+
+        config_h = Config.__table_handler__(self.module)
+        config_h.add_column('discount_product', 'INTEGER')
+        config = Config.__table__()
+        cursor.execute(*config.update(
+                [config.discount_product], [product.id]))
+        backend.TableHandler.drop_table(
+            ConfigDiscountProduct.__name__, ConfigDiscountProduct._table)
+        ConfigDiscountProduct.__register__(self.module)
+
+        record, = ConfigDiscountProduct.search([])
+        self.assertIsNone(record.company)
+        self.assertEqual(record.discount_product, product)
+
+    @with_transaction()
+    def test_discount_product_cache(self):
+        "Test discount product caches cleared by the related records"
+        pool = Pool()
+        Category = pool.get('product.category')
+        Company = pool.get('company.company')
+        Config = pool.get('account.configuration')
+        ConfigDiscountProduct = pool.get(
+            'account.configuration.discount_product')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        transaction = Transaction()
+        cache = Config._discount_product_cache
+        excluded_cache = Config._discount_global_excluded_cache
+
+        data = setup(self.extras)
+        company = Company(data['company'])
+        with transaction.set_context(data['context']):
+            product = Product(data['product'])
+            discount_product = Config(1).discount_product
+            key = (company.id, 'out', transaction.language)
+
+            Config.get_discount_product_values(company, 'out')
+            Config.get_discount_global_excluded_products()
+            Template.write([product.template], {'list_price': Decimal(50)})
+            self.assertTrue(cache.get(key))
+            self.assertIsNotNone(excluded_cache.get('products'))
+            self.assertEqual(
+                Config.get_discount_product_ids()['product.template'],
+                {discount_product.template.id})
+
+            with patch.object(ConfigDiscountProduct, 'search') as search:
+                Template.write(
+                    [product.template], {'list_price': Decimal(60)})
+            search.assert_not_called()
+
+            Template.write(
+                [discount_product.template], {'name': "Global Discount"})
+            self.assertIsNone(cache.get(key))
+            self.assertIsNotNone(excluded_cache.get('products'))
+            self.assertEqual(
+                Config.get_discount_product_values(
+                    company, 'out')['description'], "Global Discount")
+
+            Category.write(
+                [discount_product.template.account_category],
+                {'name': "Discount Category"})
+            self.assertIsNone(cache.get(key))
+
+            Config.get_discount_product_values(company, 'out')
+            category = Category(name="Category")
+            category.save()
+            self.assertTrue(cache.get(key))
+            self.assertIsNone(excluded_cache.get('products'))
+
+            Config.get_discount_global_excluded_products()
+            Template.write([product.template], {'categories': [
+                        ('add', [category.id])]})
+            self.assertTrue(cache.get(key))
+            self.assertIsNone(excluded_cache.get('products'))
+
+    @with_transaction()
+    def test_discount_global_tax_memo(self):
+        "Test tax rule applied once per batch of global discount lines"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Tax = pool.get('account.tax')
+        TaxRule = pool.get('account.tax.rule')
+
+        data = setup(self.extras)
+        with Transaction().set_context(data['context']):
+            tax, = Tax.search([])
+            other_tax, = Tax.copy([tax])
+            tax_rule = TaxRule(
+                name="Rule", kind='sale', company=data['company'],
+                lines=[{'origin_tax': tax.id, 'tax': other_tax.id}])
+            tax_rule.save()
+            parties, invoices = create_invoices(data, 3, 1)
+            Party.write(parties, {'customer_tax_rule': tax_rule.id})
+
+            enabled = instrumentation.is_enabled()
+            instrumentation.reset_stats()
+            instrumentation.enable()
+            try:
+                tax_memo = {}
+                lines = [i._get_discount_global_line(tax_memo=tax_memo)
+                    for i in invoices]
+                stats = instrumentation.get_stats()
+            finally:
+                if not enabled:
+                    instrumentation.disable()
+                instrumentation.reset_stats()
+
+            self.assertEqual(stats['caches']['tax_rule'], {
+                    'hits': 2,
+                    'misses': 1,
+                    'hit_rate': 2 / 3,
+                    })
+            self.assertEqual(
+                [list(l.taxes) for l in lines],
+                [list(i._get_discount_global_line().taxes)
+                    for i in invoices])
+            self.assertEqual(list(lines[0].taxes), [other_tax])
+
+    @with_transaction()
+    def test_post_queue_access(self):
+        "Test post queue checks the access to the post button"
+        pool = Pool()
+        Button = pool.get('ir.model.button')
+        ButtonClick = pool.get('ir.model.button.click')
+        ButtonRule = pool.get('ir.model.button.rule')
+        Group = pool.get('res.group')
+        Invoice = pool.get('account.invoice')
+        User = pool.get('res.user')
+        transaction = Transaction()
+
+        data = setup(self.extras)
+        with transaction.set_context(data['context']):
+            _, invoices = create_invoices(data, 2, 1)
+        group = Group(name="Post")
+        group.save()
+        button, = Button.search([
+                ('model', '=', 'account.invoice'),
+                ('name', '=', 'post'),
+                ])
+        button.groups = [group]
+        button.save()
+
+        with transaction.set_context(data['context']), check_access():
+            with self.assertRaises(AccessButtonError):
+                Invoice.post_queue(invoices)
+
+        User.write([User(transaction.user)], {
+                'groups': [('add', [group.id])],
+                })
+        with transaction.set_context(data['context']), check_access():
+            self.assertEqual(Invoice.post_queue(invoices), 2)
+
+        ButtonRule.create([{
+                    'button': button.id,
+                    'number_user': 2,
+                    }])
+        with transaction.set_context(data['context']), check_access():
+            self.assertEqual(Invoice.post_queue(invoices), 0)
+        self.assertEqual(ButtonClick.search([]), [])
 
 
 del ModuleTestCase
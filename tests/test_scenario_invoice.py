@@ -3,14 +3,17 @@ import unittest
 from decimal import Decimal
 
 from proteus import Model, Wizard
+from trytond.model.exceptions import AccessError
 from trytond.modules.account.tests.tools import (create_chart,
                                                  create_fiscalyear, create_tax,
                                                  get_accounts)
 from trytond.modules.account_invoice.tests.tools import (
     create_payment_term, set_fiscalyear_invoice_sequences)
 from trytond.modules.company.tests.tools import create_company, get_company
-from trytond.tests.test_tryton import drop_db
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, drop_db
 from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction, TransactionError
 
 
 class Test(unittest.TestCase):
@@ -26,7 +29,7 @@ class Test(unittest.TestCase):
     def test(self):
 
         # Install account_invoice_discount_global
-        activate_modules('account_invoice_discount_global')
+        config = activate_modules('account_invoice_discount_global')
 
         # Create company
         _ = create_company()
@@ -128,6 +131,16 @@ class Test(unittest.TestCase):
         self.assertEqual(invoice.untaxed_amount, Decimal('220.00'))
         invoice.save()
 
+        # Going back to draft removes the discount line
+        invoice.click('validate_invoice')
+        self.assertEqual(invoice.untaxed_amount, Decimal('198.00'))
+        self.assertEqual(invoice.discount_global_amount, Decimal('22.00'))
+        invoice.click('draft')
+        self.assertEqual(len(invoice.lines), 2)
+        self.assertEqual(invoice.untaxed_amount, Decimal('220.00'))
+        self.assertEqual(invoice.discount_global_amount, Decimal('0.00'))
+        self.assertEqual(invoice.tax_amount, Decimal('20.00'))
+
         # Post invoice and check discount is applied
         invoice.click('validate_invoice')
         self.assertEqual(invoice.state, 'validated')
@@ -138,11 +151,31 @@ class Test(unittest.TestCase):
             l for l in invoice.lines if l.product == discount_product
         ]
         self.assertEqual(discount_line.quantity, 1.0)
+        self.assertTrue(discount_line.discount_global)
+        self.assertEqual(discount_line.discount_global_taxes, str(tax.id))
         self.assertEqual(discount_line.amount, Decimal('-22.00'))
         self.assertEqual(invoice.untaxed_amount, Decimal('198.00'))
         self.assertEqual(invoice.tax_amount, Decimal('17.80'))
         self.assertEqual(invoice.total_amount, Decimal('215.80'))
 
+        # Check the computations and the removal are logged
+        Log = Model.get('account.invoice.discount_global.log')
+        logs = Log.find([('invoice', '=', invoice.id)], order=[('id', 'ASC')])
+        self.assertEqual(
+            [l.action for l in logs], ['compute', 'remove', 'compute'])
+        compute_log = logs[-1]
+        self.assertEqual(compute_log.base, Decimal('220.00'))
+        self.assertEqual(compute_log.rate, Decimal('0.1'))
+        self.assertEqual(compute_log.amount, Decimal('-22.000'))
+        self.assertEqual(compute_log.rounded_amount, Decimal('-22.0000'))
+        self.assertEqual(compute_log.create_uid.id, config.user)
+        self.assertEqual(logs[1].rounded_amount, Decimal('-22.0000'))
+        self.assertEqual(logs[1].base, Decimal('220.00'))
+        self.assertEqual(logs[1].rate, Decimal('0.1'))
+        self.assertEqual(logs[1].amount, Decimal('-22.000'))
+        with self.assertRaises(AccessError):
+            Log.write([compute_log.id], {'rate': Decimal(0)}, config.context)
+
         # Credit invoice with refund
         credit = Wizard('account.invoice.credit', [invoice])
         credit.form.with_refund = True
@@ -151,6 +184,33 @@ class Test(unittest.TestCase):
         self.assertEqual(invoice.state, 'cancelled')
         credit_note, = Invoice.find([('untaxed_amount', '<', Decimal(0))])
         self.assertEqual(credit_note.untaxed_amount, Decimal('-198.00'))
+        self.assertTrue(credit_note.discount_global_computed)
+        self.assertEqual(
+            credit_note.discount_global_amount, Decimal('-22.00'))
+        discount_line, = [l for l in credit_note.lines if l.discount_global]
+        self.assertEqual(discount_line.amount, Decimal('22.00'))
+
+        # The note of the lines of a posted credit note can be changed
+        InvoiceLine = Model.get('account.invoice.line')
+        InvoiceLine.write(
+            [discount_line.id], {'note': "Note"}, config.context)
+        credit_note.reload()
+        self.assertTrue(credit_note.discount_global_computed)
+
+        # Changing the lines of a credit note computes the discount again
+        credit = Wizard('account.invoice.credit', [credit_note])
+        credit.execute('credit')
+        invoice_credit, = Invoice.find([('state', '=', 'draft')])
+        self.assertTrue(invoice_credit.discount_global_computed)
+        line, = [l for l in invoice_credit.lines if l.description == 'Test']
+        line.note = "Note"
+        invoice_credit.save()
+        self.assertTrue(invoice_credit.discount_global_computed)
+        line, = [l for l in invoice_credit.lines if l.description == 'Test']
+        line.quantity = 2
+        invoice_credit.save()
+        self.assertFalse(invoice_credit.discount_global_computed)
+        invoice_credit.delete()
 
         # Duplicate invoice
         duplicate, = invoice.duplicate()
@@ -189,3 +249,256 @@ class Test(unittest.TestCase):
         self.assertEqual(invoice.untaxed_amount, Decimal('242.50'))
         self.assertEqual(invoice.tax_amount, Decimal('24.25'))
         self.assertEqual(invoice.total_amount, Decimal('266.75'))
+
+        # Keep and update the discount line when going back to draft
+        configuration.discount_global_update = True
+        configuration.save()
+        invoice = Invoice()
+        invoice.party = party
+        invoice.payment_term = payment_term
+        invoice.invoice_date = today
+        line = invoice.lines.new()
+        line.product = product
+        line.quantity = 2
+        line.unit_price = Decimal('50')
+        invoice.click('validate_invoice')
+        self.assertEqual(invoice.untaxed_amount, Decimal('95.00'))
+        invoice.click('draft')
+        self.assertEqual(len(invoice.lines), 2)
+        line, = [l for l in invoice.lines if not l.discount_global]
+        line.quantity = 4
+        invoice.click('validate_invoice')
+        discount_line, = [l for l in invoice.lines if l.discount_global]
+        self.assertEqual(discount_line.amount, Decimal('-10.00'))
+        self.assertEqual(invoice.discount_global_amount, Decimal('10.00'))
+        self.assertEqual(invoice.untaxed_amount, Decimal('190.00'))
+        self.assertEqual(invoice.tax_amount, Decimal('19.00'))
+
+        # Simulate another rate without changing the invoice
+        simulation, = Invoice.simulate_discount_global(
+            [invoice.id], Decimal('0.1'), None, config.context)
+        self.assertEqual(simulation['base'], Decimal('200.00'))
+        self.assertEqual(simulation['amount'], Decimal('20.00'))
+        self.assertEqual(simulation['tax_amount'], Decimal('-2.00'))
+        self.assertEqual(simulation['taxes'], [{
+                    'tax': tax.id,
+                    'base': Decimal('-20.00'),
+                    'amount': Decimal('-2.00'),
+                    }])
+        simulation, = Invoice.simulate_discount_global(
+            [invoice.id], None, None, config.context)
+        self.assertEqual(simulation['amount'], Decimal('10.00'))
+        simulation, = Invoice.simulate_discount_global(
+            [invoice.id], None, discount_product.id, config.context)
+        self.assertEqual(simulation['amount'], Decimal('10.00'))
+        self.assertEqual(simulation['tax_amount'], Decimal('-1.00'))
+        invoice.reload()
+        self.assertEqual(invoice.discount_global_amount, Decimal('10.00'))
+        self.assertEqual(len(invoice.lines), 2)
+
+        # Remove the updated discount line when cancelling
+        invoice.click('cancel')
+        self.assertEqual(invoice.state, 'cancelled')
+        self.assertEqual(len(invoice.lines), 1)
+        self.assertEqual(invoice.discount_global_amount, Decimal('0.00'))
+        self.assertEqual(invoice.untaxed_amount, Decimal('200.00'))
+
+        # Post invoices in background
+        invoices = []
+        for quantity in [1, 2]:
+            invoice = Invoice()
+            invoice.party = party
+            invoice.payment_term = payment_term
+            invoice.invoice_date = today
+            line = invoice.lines.new()
+            line.product = product
+            line.quantity = quantity
+            line.unit_price = Decimal('100')
+            invoice.save()
+            invoices.append(invoice)
+        post_queue = Wizard('account.invoice.post_queue', invoices)
+        self.assertEqual(post_queue.form.count, 2)
+        post_queue.execute('end')
+        for invoice, untaxed_amount in zip(
+                invoices, [Decimal('95.00'), Decimal('190.00')]):
+            invoice.reload()
+            self.assertEqual(invoice.state, 'posted')
+            self.assertEqual(invoice.untaxed_amount, untaxed_amount)
+
+        # Apply the discount brackets to the parties without discount
+        Bracket = Model.get('party.invoice_discount.bracket')
+        for amount, discount in [(1000, '0.02'), (10000, '0.05')]:
+            bracket = Bracket()
+            bracket.type = 'out'
+            bracket.amount = Decimal(amount)
+            bracket.discount = Decimal(discount)
+            bracket.save()
+        bracket_party = Party(name="Bracket Party")
+        line = bracket_party.invoice_discount_brackets.new()
+        line.type = 'out'
+        line.amount = Decimal('0')
+        line.discount = Decimal('0.10')
+        bracket_party.save()
+        default_party = Party(name="Default Party")
+        default_party.save()
+        for invoice_party, price, untaxed_amount in [
+                (default_party, Decimal('500'), Decimal('500.00')),
+                (default_party, Decimal('2000'), Decimal('1960.00')),
+                (default_party, Decimal('10000'), Decimal('9500.00')),
+                (bracket_party, Decimal('100'), Decimal('90.00')),
+                ]:
+            invoice = Invoice()
+            invoice.party = invoice_party
+            invoice.payment_term = payment_term
+            invoice.invoice_date = today
+            line = invoice.lines.new()
+            line.product = product
+            line.quantity = 1
+            line.unit_price = price
+            invoice.save()
+            self.assertFalse(invoice.invoice_discount)
+            invoice.click('post')
+            self.assertEqual(invoice.untaxed_amount, untaxed_amount)
+
+        # Distribute the discount per tax
+        configuration.discount_global_per_tax = True
+        configuration.save()
+        invoice = Invoice()
+        invoice.party = party
+        invoice.payment_term = payment_term
+        invoice.invoice_date = today
+        line = invoice.lines.new()
+        line.product = product
+        line.quantity = 2
+        line.unit_price = Decimal('100')
+        line = invoice.lines.new()
+        line.account = revenue
+        line.description = "Exempt"
+        line.quantity = 1
+        line.unit_price = Decimal('50')
+        invoice.click('validate_invoice')
+        self.assertEqual(
+            sorted((l.amount, len(l.taxes))
+                for l in invoice.lines if l.discount_global),
+            [(Decimal('-10.00'), 1), (Decimal('-2.50'), 0)])
+        self.assertEqual(
+            sorted(l.discount_global_taxes
+                for l in invoice.lines if l.discount_global),
+            ['', str(tax.id)])
+        self.assertEqual(invoice.untaxed_amount, Decimal('237.50'))
+        self.assertEqual(invoice.tax_amount, Decimal('19.00'))
+        invoice.click('draft')
+        line, = [l for l in invoice.lines if l.description == "Exempt"]
+        line.quantity = 2
+        invoice.click('validate_invoice')
+        self.assertEqual(
+            sorted((l.amount, len(l.taxes))
+                for l in invoice.lines if l.discount_global),
+            [(Decimal('-10.00'), 1), (Decimal('-5.00'), 0)])
+        self.assertEqual(invoice.untaxed_amount, Decimal('285.00'))
+        self.assertEqual(invoice.tax_amount, Decimal('19.00'))
+        self.assertEqual(invoice.discount_global_amount, Decimal('15.00'))
+
+        # Update the draft invoices when the party discount changes
+        invoice = Invoice()
+        invoice.party = party
+        invoice.payment_term = payment_term
+        invoice.invoice_date = today
+        line = invoice.lines.new()
+        line.product = product
+        line.quantity = 1
+        line.unit_price = Decimal('100')
+        invoice.click('validate_invoice')
+        invoice.click('draft')
+        self.assertEqual(invoice.untaxed_amount, Decimal('95.00'))
+        party.customer_invoice_discount = Decimal('0.08')
+        party.save()
+        Cron = Model.get('ir.cron')
+        cron, = Cron.find([
+                ('method', '=',
+                    'account.invoice|update_draft_invoice_discounts'),
+                ('active', '=', False),
+                ])
+        cron.click('run_once')
+        invoice.reload()
+        self.assertEqual(invoice.invoice_discount, Decimal('0.08'))
+        self.assertEqual(invoice.untaxed_amount, Decimal('92.00'))
+        self.assertEqual(invoice.discount_global_amount, Decimal('8.00'))
+
+        # Analyse the global discounts of the posted invoices per party
+        Analysis = Model.get('account.invoice.discount_global.analysis')
+        invoices = Invoice.find([
+                ('type', '=', 'out'),
+                ('state', 'in', ['posted', 'paid']),
+                ('discount_global_amount', '!=', 0),
+                ])
+        with config.set_context(company=company.id, type='out'):
+            analyses = Analysis.find([])
+        self.assertEqual(
+            sum(a.count for a in analyses), len(invoices))
+        self.assertEqual(
+            {a.party for a in analyses}, {i.party for i in invoices})
+        self.assertEqual(
+            sum(a.amount for a in analyses),
+            sum(i.discount_global_amount for i in invoices))
+        self.assertEqual(
+            sum(a.base for a in analyses),
+            sum(i.untaxed_amount + i.discount_global_amount
+                for i in invoices))
+        period, = [p for p in fiscalyear.periods
+            if p.start_date <= today <= p.end_date]
+        with config.set_context(
+                company=company.id, start_period=period.id,
+                end_period=period.id):
+            analyses = Analysis.find([])
+        self.assertEqual(
+            sum(a.count for a in analyses if a.type == 'out'), len(invoices))
+        self.assertEqual(
+            sum(a.count for a in analyses if a.type == 'in'),
+            len(Invoice.find([
+                        ('type', '=', 'in'),
+                        ('state', 'in', ['posted', 'paid']),
+                        ('discount_global_amount', '!=', 0),
+                        ])))
+
+        # Lock the validated invoices in two transactions
+        invoices = []
+        for quantity in [1, 2]:
+            invoice = Invoice()
+            invoice.party = party
+            invoice.payment_term = payment_term
+            invoice.invoice_date = today
+            line = invoice.lines.new()
+            line.product = product
+            line.quantity = quantity
+            line.unit_price = Decimal('100')
+            invoice.click('validate_invoice')
+            invoices.append(invoice)
+        invoice_ids = [i.id for i in invoices]
+        extras = {}
+        while True:
+            with Transaction().start(
+                    DB_NAME, config.user, context=config.context,
+                    **extras) as transaction:
+                LockInvoice = Pool().get('account.invoice')
+                locked = LockInvoice.browse(invoice_ids)
+                if not extras:
+                    # the invoices were created by another transaction
+                    with self.assertRaises(TransactionError):
+                        LockInvoice.draft(locked)
+                try:
+                    locked = LockInvoice.lock_skip_locked(locked)
+                except TransactionError as e:
+                    # without SKIP LOCKED the transaction is restarted
+                    self.assertFalse(transaction.database.has_select_for())
+                    e.fix(extras)
+                    continue
+                self.assertEqual([i.id for i in locked], invoice_ids)
+                if transaction.database.has_select_for():
+                    with transaction.new_transaction():
+                        self.assertEqual(LockInvoice.lock_skip_locked(
+                                LockInvoice.browse(invoice_ids)), [])
+                LockInvoice.draft(locked)
+                self.assertEqual({i.state for i in locked}, {'draft'})
+                transaction.rollback()
+            break
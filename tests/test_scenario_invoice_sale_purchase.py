@@ -125,6 +125,9 @@ class Test(unittest.TestCase):
         self.assertEqual(sale.untaxed_amount, Decimal('200.00'))
         self.assertEqual(sale.tax_amount, Decimal('20.00'))
         self.assertEqual(sale.total_amount, Decimal('220.00'))
+        self.assertEqual(sale.discount_global_amount, Decimal('10.00'))
+        self.assertEqual(
+            sale.discount_global_total_amount, Decimal('209.00'))
         self.assertEqual(len(sale.shipments), 0)
 
         self.assertEqual(len(sale.shipment_returns), 0)
@@ -167,6 +170,9 @@ class Test(unittest.TestCase):
         self.assertEqual(purchase.untaxed_amount, Decimal('75.00'))
         self.assertEqual(purchase.tax_amount, Decimal('7.50'))
         self.assertEqual(purchase.total_amount, Decimal('82.50'))
+        self.assertEqual(purchase.discount_global_amount, Decimal('2.25'))
+        self.assertEqual(
+            purchase.discount_global_total_amount, Decimal('80.03'))
         self.assertEqual(len(purchase.moves), 0)
 
         self.assertEqual(len(purchase.shipment_returns), 0)
@@ -192,3 +198,15 @@ class Test(unittest.TestCase):
         self.assertEqual(invoice.untaxed_amount, Decimal('72.75'))
         self.assertEqual(invoice.tax_amount, Decimal('7.28'))
         self.assertEqual(invoice.total_amount, Decimal('80.03'))
+
+        # The preview uses the discount of the invoice party
+        purchase = Purchase()
+        purchase.party = customer
+        purchase.invoice_party = supplier
+        purchase.payment_term = payment_term
+        purchase_line = purchase.lines.new()
+        purchase_line.product = product
+        purchase_line.quantity = 3.0
+        purchase_line.unit_price = product.cost_price
+        purchase.save()
+        self.assertEqual(purchase.discount_global_amount, Decimal('2.25'))
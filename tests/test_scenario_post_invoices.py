@@ -0,0 +1,184 @@
+import argparse
+import io
+import unittest
+from concurrent import futures
+from contextlib import redirect_stderr, redirect_stdout
+from decimal import Decimal
+from unittest.mock import patch
+
+from proteus import Model
+from trytond import backend
+from trytond.exceptions import UserError
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    create_payment_term, set_fiscalyear_invoice_sequences)
+from trytond.modules.account_invoice_discount_global import post_invoices
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, drop_db
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+
+class Executor:
+    "Run the tasks in the process like ProcessPoolExecutor"
+
+    def __init__(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def submit(self, func, *args, **kwargs):
+        future = futures.Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as exception:
+            future.set_exception(exception)
+        return future
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Install account_invoice_discount_global
+        config = activate_modules('account_invoice_discount_global')
+
+        # Create company
+        _ = create_company()
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+
+        # Create payment term
+        payment_term = create_payment_term()
+        payment_term.save()
+
+        # Create draft invoices of three parties
+        Party = Model.get('party.party')
+        Invoice = Model.get('account.invoice')
+        parties = []
+        for name in ["Party 1", "Party 2", "Party 3"]:
+            party = Party(name=name)
+            party.save()
+            parties.append(party)
+        invoices = []
+        for party, count in zip(parties, [3, 2, 2]):
+            for _ in range(count):
+                invoice = Invoice()
+                invoice.party = party
+                invoice.payment_term = payment_term
+                line = invoice.lines.new()
+                line.account = accounts['revenue']
+                line.description = "Line"
+                line.quantity = 1
+                line.unit_price = Decimal('10')
+                invoice.save()
+                invoices.append(invoice)
+        ids = [i.id for i in invoices]
+
+        # Move the last invoice to another company
+        Company = Model.get('company.company')
+        other_party = Party(name="Other")
+        other_party.save()
+        other_company = Company(party=other_party)
+        other_company.currency = company.currency
+        other_company.save()
+        with Transaction().start(DB_NAME, 0) as transaction:
+            table = Pool().get('account.invoice').__table__()
+            transaction.connection.cursor().execute(*table.update(
+                    [table.company], [other_company.id],
+                    where=table.id == ids[-1]))
+
+        # The chunks keep the parties whole and split by company
+        self.assertEqual(
+            list(post_invoices.get_chunks(DB_NAME, None, 2)), [
+                (company.id, ids[0:3]),
+                (company.id, ids[3:5]),
+                (company.id, ids[5:6]),
+                (other_company.id, ids[6:7]),
+                ])
+        self.assertEqual(
+            list(post_invoices.get_chunks(DB_NAME, None, 10)), [
+                (company.id, ids[0:6]),
+                (other_company.id, ids[6:7]),
+                ])
+        self.assertEqual(
+            list(post_invoices.get_chunks(
+                    DB_NAME, [other_company.id], 10)),
+            [(other_company.id, ids[6:7])])
+
+        # Post a chunk retried on database operational errors
+        user, context = post_invoices.get_user_context(
+            DB_NAME, 'admin', company.id, skip_warnings=True)
+        PoolInvoice = Pool(DB_NAME).get('account.invoice')
+        post = PoolInvoice.post
+        calls = []
+
+        def post_once(invoices):
+            calls.append(invoices)
+            if len(calls) == 1:
+                raise backend.DatabaseOperationalError
+            return post(invoices)
+
+        with patch.object(PoolInvoice, 'post', side_effect=post_once):
+            self.assertEqual(
+                post_invoices.post_chunk(
+                    DB_NAME, user, context, ids[0:3], 1), 3)
+        # the locks may also restart the transaction
+        self.assertGreaterEqual(len(calls), 2)
+        with patch.object(PoolInvoice, 'post',
+                side_effect=backend.DatabaseOperationalError):
+            with self.assertRaises(backend.DatabaseOperationalError):
+                post_invoices.post_chunk(
+                    DB_NAME, user, context, ids[3:5], 0)
+        self.assertEqual(
+            [Invoice(i).state for i in ids[0:5]],
+            ['posted'] * 3 + ['draft'] * 2)
+
+        # Post the remaining invoices and print the failed chunks
+        def post_company(invoices):
+            if any(i.company.id == other_company.id for i in invoices):
+                raise UserError("Other company")
+            return post(invoices)
+
+        options = argparse.Namespace(
+            database_names=[DB_NAME], configfile=None, processes=1,
+            companies=None, chunk_size=2, retries=0, user='admin',
+            skip_warnings=True, skip_locked=False)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with patch.object(PoolInvoice, 'post', side_effect=post_company), \
+                patch.object(post_invoices, 'initializer'), \
+                patch.object(
+                    post_invoices.futures, 'ProcessPoolExecutor', Executor), \
+                redirect_stdout(stdout), redirect_stderr(stderr):
+            self.assertEqual(post_invoices.run(options), 1)
+        self.assertIn(
+            "3 chunks, 3 of 4 invoices posted, 1 chunks failed",
+            stdout.getvalue())
+        self.assertIn(
+            "company %s, invoices %s: Other company" % (
+                other_company.id, ids[6]),
+            stderr.getvalue())
+        self.assertEqual(
+            [Invoice(i).state for i in ids[0:6]], ['posted'] * 6)